@@ -1,36 +1,175 @@
 import os
 import discord
+from discord import app_commands
 from discord.ext import commands
 import asyncio
 import stripe
 import requests
 import aiohttp
+from aiohttp import web
 import time
-from datetime import datetime
+import random
+import functools
+import hashlib
+import io
+import tempfile
+import contextlib
+import csv
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Literal, Optional
+import logging
+import logging.handlers
+import queue
+import contextvars
+import atexit
+import json
+import multiprocessing
+import sys
+import threading
+import traceback
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from PIL import Image, ImageOps
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily
 
 # Load environment variables
 load_dotenv()
+
+# --- Logging ---
+# Records are put on an in-memory queue from the event loop and written to
+# stdout as JSON lines by a QueueListener thread, so a slow stdout never
+# stalls the loop. Every record carries the interaction/job it belongs to.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # share of high-volume (poll) records kept
+SAMPLED = {"sampled": True}  # pass as extra= on high-volume records
+
+interaction_id_var = contextvars.ContextVar("interaction_id", default=None)
+job_id_var = contextvars.ContextVar("job_id", default=None)
+
+class ContextFilter(logging.Filter):
+    """Attaches correlation IDs and drops most sampled records below WARNING."""
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno < logging.WARNING and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        record.interaction_id = getattr(record, "interaction_id", None) or interaction_id_var.get()
+        record.job_id = getattr(record, "job_id", None) or job_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key in ["interaction_id", "job_id"]:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(interaction_id)s %(job_id)s] %(message)s"))
+
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(ContextFilter())  # runs on the calling thread, where the context vars are set
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("discord").setLevel(max(logging.INFO, root.level))
+
+log = logging.getLogger("kolde")
 TOKEN = os.getenv("DISCORD_TOKEN")
 RUNWAY_API_KEY = os.getenv("RUNWAY_API_KEY")
 CHANNEL_ID = 1227704136552939551
+GUILD_ID = 1227704136552939551
 ACCESS_ROLE_ID = 1227708209356345454
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not TOKEN or not RUNWAY_API_KEY:
-    print("❌ ERROR: Missing bot token or API key!")
-    exit(1)
+# Created on first use (see create_app for the rest of the startup configuration),
+# so importing bot.py opens no connections
+supabase_client: Optional[Client] = None
+supabase_lock = threading.Lock()
 
-stripe.api_key = STRIPE_SECRET_KEY
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+def get_supabase() -> Client:
+    """The shared Supabase client. The first call usually comes from a db_executor thread."""
+    global supabase_client
+    if supabase_client is None:
+        with supabase_lock:
+            if supabase_client is None:
+                supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase_client
 
 CREDIT_COST = 0.4
 MIN_CREDITS = 5
 
+# --- Metrics ---
+# Exposed in Prometheus text format at /metrics on the bot's HTTP server (see start_http_server)
+# With SERVE_WEBHOOK=1 the bot is the web service and takes Render's $PORT
+SERVE_WEBHOOK = os.getenv("SERVE_WEBHOOK") == "1"
+HTTP_PORT = int((SERVE_WEBHOOK and os.getenv("PORT")) or os.getenv("METRICS_PORT") or "9100")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+GENERATION_BUCKETS = (15, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600)
+
+INTERACTION_SECONDS = Histogram("kolde_interaction_seconds", "Time spent handling an interaction", ["action"],
+                                buckets=LATENCY_BUCKETS + (120, 300, 600))
+BLOCKING_CALL_SECONDS = Histogram("kolde_blocking_call_seconds", "Latency of Supabase/Stripe calls, including pool wait",
+                                  ["pool", "call"], buckets=LATENCY_BUCKETS)
+RUNWAY_REQUESTS = Counter("kolde_runway_requests_total", "Runway API responses by method and status", ["method", "status"])
+JOB_COMPLETION_SECONDS = Histogram("kolde_job_completion_seconds", "Time from job submission to a final status",
+                                   ["outcome"], buckets=GENERATION_BUCKETS)
+JOB_POLLS = Histogram("kolde_job_polls", "Status checks needed per job", buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55))
+
+# Blocking Supabase calls run on this pool instead of the event loop
+SUPABASE_WORKERS = int(os.getenv("SUPABASE_WORKERS", "8"))
+db_executor = ThreadPoolExecutor(max_workers=SUPABASE_WORKERS, thread_name_prefix="supabase")
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """Runs a blocking call in a worker thread (db_executor unless another pool is given).
+
+    Process pools work too; func and its arguments must then be picklable.
+    """
+    executor = executor or db_executor
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    finally:
+        pool = getattr(executor, "_thread_name_prefix", None) or "process"
+        BLOCKING_CALL_SECONDS.labels(pool, func.__name__).observe(time.perf_counter() - started)
+
+RUNWAY_API_BASE = os.getenv("RUNWAY_API_BASE", "https://api.aivideoapi.com")
+
+# Shared HTTP client settings (all Runway API traffic goes through one pooled session)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "30"))
+
+http_session = None
+
 def create_checkout_session(user_id):
+    """Returns the session URL and when it expires."""
+    # Stamped here, after the wait for a stripe_executor thread, so the queue time doesn't eat into the TTL
+    expires_at = int(time.time()) + CHECKOUT_SESSION_TTL
     session = stripe.checkout.Session.create(
         payment_method_types=["card"],
         mode="payment",
@@ -44,9 +183,10 @@ def create_checkout_session(user_id):
             },
             "quantity": 1,
         }],
-        metadata={"user_id": user_id, "type": "access"}
+        metadata={"user_id": user_id, "type": "access"},
+        expires_at=expires_at
     )
-    return session.url
+    return session.url, expires_at
 
 def create_credit_purchase_session(user_id, amount):
     quantity = max(amount, MIN_CREDITS)
@@ -68,39 +208,509 @@ def create_credit_purchase_session(user_id, amount):
     )
     return session.url
 
-def get_credits(user_id):
-    response = supabase.table("user_credits").select("credits").eq("user_id", user_id).execute()
+# --- Stripe checkout ---
+# Stripe calls are blocking HTTP requests, so they run on their own small pool.
+# Access checkouts have a fixed price, so an unexpired session is handed out
+# again instead of creating a new one on every click.
+STRIPE_WORKERS = int(os.getenv("STRIPE_WORKERS", "4"))
+stripe_executor = ThreadPoolExecutor(max_workers=STRIPE_WORKERS, thread_name_prefix="stripe")
+CHECKOUT_SESSION_TTL = 35 * 60  # Stripe rejects anything under 30 minutes, measured on its side
+CHECKOUT_REUSE_MARGIN = 5 * 60  # don't hand out a session that's about to expire
+
+access_checkout_cache = {}  # user_id -> (url, expires_at)
+
+async def get_access_checkout_url(user_id):
+    now = time.time()
+    cached = access_checkout_cache.get(user_id)
+    if cached and cached[1] - CHECKOUT_REUSE_MARGIN > now:
+        return cached[0]
+
+    url, expires_at = await run_blocking(create_checkout_session, user_id, executor=stripe_executor)
+    for stale in [uid for uid, (_, expiry) in access_checkout_cache.items() if expiry <= now]:
+        del access_checkout_cache[stale]
+    access_checkout_cache[user_id] = (url, expires_at)
+    return url
+
+async def get_credit_checkout_url(user_id, amount):
+    return await run_blocking(create_credit_purchase_session, user_id, amount, executor=stripe_executor)
+
+# --- Credit ledger ---
+# Balances live in user_credits and every change is appended to
+# credit_transactions. Each change and its ledger row are written by one
+# database function (change_credits in schema.sql), so a balance can never
+# go below zero and a purchase or refund whose reference is already in the
+# ledger is not applied twice. All Supabase calls run in db_executor so they
+# don't block the event loop.
+CREDIT_CAS_RETRIES = 5
+
+def fetch_credits(user_id):
+    response = get_supabase().table("user_credits").select("credits").eq("user_id", user_id).execute()
     if response.data:
         return response.data[0]["credits"]
     return 0
 
-def add_credits(user_id, amount):
-    current = get_credits(user_id)
-    if current:
-        supabase.table("user_credits").update({"credits": current + amount}).eq("user_id", user_id).execute()
-    else:
-        supabase.table("user_credits").upsert({"user_id": user_id, "credits": amount}).execute()
+def apply_credit_change(user_id, delta, reason, reference=None):
+    """Adds delta to a balance. Returns (balance, applied); when nothing was applied, balance is the current one."""
+    response = get_supabase().rpc("change_credits", {
+        "change_user": str(user_id),
+        "change_delta": delta,
+        "change_reason": reason,
+        "change_reference": reference
+    }).execute()
+    row = response.data[0]
+    return row["balance"], row["applied"]
+
+# --- Balance cache ---
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "30"))
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+
+class BalanceCache:
+    """In-process TTL + LRU cache of credit balances keyed by user_id.
+
+    Ledger writes made by this process update the cache directly. Writes
+    from anywhere else only become visible once the entry expires, so the
+    TTL bounds how stale a balance can be.
+    """
+
+    def __init__(self, ttl=BALANCE_CACHE_TTL, maxsize=BALANCE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # user_id -> (balance, expires_at)
+        self.generation = 0  # bumped on every write so stale reads can't overwrite newer balances
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(str(user_id))
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(str(user_id))
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, balance):
+        self.generation += 1
+        self._store(user_id, balance)
+
+    def fill(self, user_id, balance, generation):
+        """Stores a balance read from the database, unless a write happened while it was being read."""
+        if generation == self.generation:
+            self._store(user_id, balance)
+
+    def invalidate(self, user_id):
+        self.generation += 1
+        self.entries.pop(str(user_id), None)
+
+    def _store(self, user_id, balance):
+        self.entries[str(user_id)] = (balance, time.monotonic() + self.ttl)
+        self.entries.move_to_end(str(user_id))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+balance_cache = BalanceCache()
+
+async def get_credits(user_id):
+    balance = balance_cache.get(user_id)
+    if balance is not None:
+        return balance
+    generation = balance_cache.generation
+    balance = await run_blocking(fetch_credits, user_id)
+    balance_cache.fill(user_id, balance, generation)
+    return balance
+
+async def change_credits(user_id, delta, reason, reference=None):
+    """Returns the new balance, or None if the change wasn't applied (see apply_credit_change)."""
+    try:
+        balance, applied = await run_blocking(apply_credit_change, user_id, delta, reason, reference)
+    except Exception:
+        balance_cache.invalidate(user_id)
+        raise
+    balance_cache.set(user_id, balance)
+    return balance if applied else None
+
+async def add_credits(user_id, amount, reason="admin_grant", reference=None):
+    return await change_credits(user_id, amount, reason, reference)
+
+async def deduct_credits(user_id, amount, reason="generation", reference=None):
+    return await change_credits(user_id, -amount, reason, reference) is not None
+
+def zero_credits(user_id, reason):
+    """Takes the whole balance. Retried if it is spent in the meantime; returns what is left."""
+    for _ in range(CREDIT_CAS_RETRIES):
+        current = fetch_credits(user_id)
+        if current == 0:
+            return 0
+        balance, applied = apply_credit_change(user_id, -current, reason)
+        if applied:
+            return balance
+    raise RuntimeError(f"Credit update for {user_id} kept conflicting, giving up after {CREDIT_CAS_RETRIES} attempts")
+
+async def clear_credits(user_id, reason="admin_remove"):
+    try:
+        balance = await run_blocking(zero_credits, user_id, reason)
+    except Exception:
+        balance_cache.invalidate(user_id)
+        raise
+    balance_cache.set(user_id, balance)
+
+# Bulk grants go through the grant_credits_bulk function (schema.sql): one
+# upsert that increments every balance in place and logs each grant in
+# credit_transactions, so a batch is one round trip. Like change_credits
+# it skips refunds that are already in the ledger.
+BULK_CREDIT_BATCH_SIZE = 200
+
+def apply_bulk_credits(grants, reason):
+    """grants: [{"user_id", "delta", "reference"}], deltas > 0. Returns {user_id: new balance}."""
+    response = get_supabase().rpc("grant_credits_bulk", {"grants": grants, "grant_reason": reason}).execute()
+    return {str(row["user_id"]): row["credits"] for row in response.data}
+
+async def bulk_add_credits(grants, reason):
+    balances = {}
+    for start in range(0, len(grants), BULK_CREDIT_BATCH_SIZE):
+        batch = grants[start:start + BULK_CREDIT_BATCH_SIZE]
+        try:
+            balances.update(await run_blocking(apply_bulk_credits, batch, reason))
+        except Exception:
+            for grant in batch:
+                balance_cache.invalidate(grant["user_id"])
+            raise
+    for user_id, balance in balances.items():
+        balance_cache.set(user_id, balance)
+    return balances
+
+def save_video(user_id, url, prompt=None):
+    row = {
+        "user_id": str(user_id),
+        "prompt": prompt,
+        "video_url": url,
+        "generated_at": datetime.utcnow().isoformat()
+    }
+    get_supabase().table("video_history").insert(row).execute()
+    return row
+
+# --- Video history ---
+# History is paged with keyset cursors on (user_id, generated_at) and served
+# by the video_history_user_generated_idx index (see schema.sql), so every
+# page costs the same no matter how deep the user has scrolled.
+HISTORY_PAGE_SIZE = 10
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "1000"))
+HISTORY_CACHE_PAGES = 5  # cached pages per user
+
+def fetch_video_history_page(user_id, older_than=None, newer_than=None, limit=HISTORY_PAGE_SIZE):
+    """Returns one page of a user's history, newest first.
+
+    older_than/newer_than are generated_at cursors taken from the last/first
+    entry of the page the user is currently looking at.
+    """
+    query = get_supabase().table("video_history").select("video_url, generated_at").eq("user_id", user_id)
+
+    if newer_than:
+        rows = query.gt("generated_at", newer_than).order("generated_at").limit(limit + 1).execute().data
+        return {"videos": rows[:limit][::-1], "has_newer": len(rows) > limit, "has_older": True}
+
+    if older_than:
+        query = query.lt("generated_at", older_than)
+    rows = query.order("generated_at", desc=True).limit(limit + 1).execute().data
+    return {"videos": rows[:limit], "has_newer": older_than is not None, "has_older": len(rows) > limit}
+
+class HistoryCache:
+    """Recently viewed history pages per user, keyed by ("older"|"newer", cursor).
+
+    Pages older than a cursor never change when a video is added, so inserts
+    only patch the first page and drop the "newer" pages.
+    """
+
+    def __init__(self, max_users=HISTORY_CACHE_USERS, max_pages=HISTORY_CACHE_PAGES):
+        self.max_users = max_users
+        self.max_pages = max_pages
+        self.users = OrderedDict()  # user_id -> OrderedDict(key -> page)
+
+    def get(self, user_id, key):
+        pages = self.users.get(str(user_id))
+        if pages is None or key not in pages:
+            return None
+        self.users.move_to_end(str(user_id))
+        pages.move_to_end(key)
+        return pages[key]
+
+    def put(self, user_id, key, page):
+        pages = self.users.setdefault(str(user_id), OrderedDict())
+        pages[key] = page
+        pages.move_to_end(key)
+        while len(pages) > self.max_pages:
+            pages.popitem(last=False)
+        self.users.move_to_end(str(user_id))
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+    def on_insert(self, user_id, row):
+        pages = self.users.get(str(user_id))
+        if pages is None:
+            return
+        for key in [key for key in pages if key[0] == "newer"]:
+            del pages[key]
+        first = pages.get(("older", None))
+        if first is not None:
+            videos = [row] + first["videos"]
+            pages[("older", None)] = {
+                "videos": videos[:HISTORY_PAGE_SIZE],
+                "has_newer": False,
+                "has_older": first["has_older"] or len(videos) > HISTORY_PAGE_SIZE
+            }
+
+history_cache = HistoryCache()
+
+async def get_history_page(user_id, older_than=None, newer_than=None):
+    key = ("newer", newer_than) if newer_than else ("older", older_than)
+    page = history_cache.get(user_id, key)
+    if page is None:
+        page = await run_blocking(fetch_video_history_page, user_id, older_than, newer_than)
+        history_cache.put(user_id, key, page)
+    return page
+
+async def record_video(user_id, url, prompt=None):
+    row = await run_blocking(save_video, user_id, url, prompt)
+    history_cache.on_insert(user_id, {"video_url": row["video_url"], "generated_at": row["generated_at"]})
+
+# --- Generation jobs ---
+# Every paid request is recorded in the generation_jobs table before it is
+# charged, so that polling and delivery can resume after a restart and
+# credits taken for a request still waiting for a scheduler slot are never lost:
+#   queued -> submitted -> running -> succeeded -> delivered
+#        \                        \-> failed
+#         \-> failed (never reached the provider, see release_queued_jobs)
+# A queued row is keyed by its request ID until it has a provider job.
+JOB_UNFINISHED_STATUSES = ["submitted", "running", "succeeded"]
+
+def new_request_id():
+    return f"request:{os.urandom(8).hex()}"
+
+def create_job_record(request_id, user_id, prompt, aspect_ratio, image_url, credits):
+    now = datetime.utcnow().isoformat()
+    get_supabase().table("generation_jobs").insert({
+        "job_id": request_id,
+        "user_id": str(user_id),
+        "prompt": prompt,
+        "aspect_ratio": aspect_ratio,
+        "image_url": image_url,
+        "credits": credits,
+        "status": "queued",
+        "created_at": now,
+        "updated_at": now
+    }).execute()
+
+def assign_job(request_id, user_id, job_id):
+    """Re-keys a queued request to the provider job it was submitted as or joined."""
+    update = {"job_id": job_id, "status": "submitted", "updated_at": datetime.utcnow().isoformat()}
+    get_supabase().table("generation_jobs").update(update).eq("job_id", request_id).eq("user_id", str(user_id)).execute()
+
+def delete_job_record(request_id, user_id):
+    get_supabase().table("generation_jobs").delete().eq("job_id", request_id).eq("user_id", str(user_id)).execute()
+
+def update_job_status(job_id, status, video_url=None, user_id=None):
+    """Updates a job for every user waiting on it, or only for user_id (e.g. "delivered")."""
+    update = {"status": status, "updated_at": datetime.utcnow().isoformat()}
+    if video_url:
+        update["video_url"] = video_url
+    query = get_supabase().table("generation_jobs").update(update).eq("job_id", job_id)
+    if user_id is not None:
+        query = query.eq("user_id", str(user_id))
+    query.execute()
+
+def fetch_unfinished_jobs():
+    response = get_supabase().table("generation_jobs").select("*").in_("status", JOB_UNFINISHED_STATUSES).order("created_at").execute()
+    return response.data
+
+async def record_job_status(job_id, status, video_url=None, user_id=None):
+    # Job bookkeeping must never break delivery, so failures are only logged
+    try:
+        await run_blocking(update_job_status, job_id, status, video_url, user_id)
+    except Exception as e:
+        log.warning(f"⚠️ Could not mark job {job_id} as {status}: {e}")
+
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def get_http_session():
+    """Returns the bot-wide HTTP session, creating it if it is missing or was closed."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+        log.info(f"🌐 HTTP session ready (pool={HTTP_POOL_LIMIT}, per_host={HTTP_POOL_LIMIT_PER_HOST})")
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        log.info("🌐 HTTP session closed.")
+    http_session = None
+
+def runway_headers():
+    return {
+        "Authorization": f"Bearer {RUNWAY_API_KEY}",
+        "Content-Type": "application/json"
+    }
 
-def deduct_credits(user_id, amount):
-    current = get_credits(user_id)
-    if current >= amount:
-        supabase.table("user_credits").update({"credits": current - amount}).eq("user_id", user_id).execute()
-        return True
-    return False
+# --- Resilient Runway client ---
+RUNWAY_RETRY_ATTEMPTS = int(os.getenv("RUNWAY_RETRY_ATTEMPTS", "4"))
+RUNWAY_RETRY_BASE_DELAY = float(os.getenv("RUNWAY_RETRY_BASE_DELAY", "1"))
+RUNWAY_RETRY_MAX_DELAY = float(os.getenv("RUNWAY_RETRY_MAX_DELAY", "30"))
+RUNWAY_BREAKER_THRESHOLD = int(os.getenv("RUNWAY_BREAKER_THRESHOLD", "5"))  # consecutive failures before opening
+RUNWAY_BREAKER_RESET = float(os.getenv("RUNWAY_BREAKER_RESET", "60"))  # seconds before a trial request is let through
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+
+class ProviderUnavailable(Exception):
+    """Raised when the circuit breaker is open or retries ran out on transient errors."""
+
+class CircuitBreaker:
+    """Fails fast while a dependency is down.
+
+    After `threshold` consecutive failures the breaker opens and rejects
+    calls for `reset_timeout` seconds. After that one trial call is let
+    through (half-open). The breaker closes if the trial succeeds and
+    opens again if it fails.
+    """
+
+    def __init__(self, name, threshold=RUNWAY_BREAKER_THRESHOLD, reset_timeout=RUNWAY_BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            log.info(f"🟢 {self.name} circuit closed again.")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def abandon_trial(self):
+        """The trial call was cancelled before it had an outcome; let the next call be the trial."""
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.info(f"🔴 {self.name} circuit opened after {self.failures} consecutive failures.")
+            self.opened_at = time.monotonic()
+
+runway_breaker = CircuitBreaker("Runway")
+
+def retry_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, or the server's Retry-After if it sent one."""
+    if retry_after:
+        try:
+            return min(float(retry_after), RUNWAY_RETRY_MAX_DELAY)
+        except ValueError:
+            pass  # HTTP-date form, fall back to our own backoff
+    return random.uniform(0, min(RUNWAY_RETRY_MAX_DELAY, RUNWAY_RETRY_BASE_DELAY * 2 ** attempt))
+
+async def runway_request(method, path, json=None, idempotent=True, attempts=RUNWAY_RETRY_ATTEMPTS):
+    """Sends a Runway API request with retries and circuit breaking. Returns (http_status, data).
+
+    Idempotent requests are retried on timeouts, connection errors, 429
+    and 5xx. Non-idempotent ones (job submission) are only retried when
+    the provider clearly did not accept them: 429, 503, or a connection
+    that never opened. Retrying after a timeout could create a duplicate
+    paid job.
+    """
+    session = get_http_session()
+    for attempt in range(attempts):
+        trial = runway_breaker.state == "half_open"
+        if not runway_breaker.allow():
+            raise ProviderUnavailable("Runway API circuit is open")
+
+        retry_after = None
+        try:
+            async with session.request(method, f"{RUNWAY_API_BASE}{path}", json=json, headers=runway_headers()) as response:
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    data = None
+                status = response.status
+                retry_after = response.headers.get("Retry-After")
+            RUNWAY_REQUESTS.labels(method, status).inc()
+        except aiohttp.ClientConnectorError as e:
+            RUNWAY_REQUESTS.labels(method, "error").inc()
+            runway_breaker.record_failure()
+            error = e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            RUNWAY_REQUESTS.labels(method, "error").inc()
+            runway_breaker.record_failure()
+            if not idempotent:
+                raise
+            error = e
+        except asyncio.CancelledError:
+            if trial:
+                runway_breaker.abandon_trial()
+            raise
+        except Exception:
+            runway_breaker.record_failure()
+            raise
+        else:
+            if status < 500 and status != 429:
+                runway_breaker.record_success()
+                return status, data
+
+            runway_breaker.record_failure()
+            retryable = status in RETRYABLE_STATUSES if idempotent else status in [429, 503]
+            if not retryable:
+                return status, data
+            error = f"HTTP {status}"
 
-def save_video(user_id, url):
-    supabase.table("video_history").insert({"user_id": user_id, "video_url": url, "generated_at": datetime.utcnow().isoformat()}).execute()
+        if attempt + 1 < attempts:
+            delay = retry_delay(attempt, retry_after)
+            log.info(f"🔁 Runway {method} {path} failed ({error}), retrying in {delay:.1f}s ({attempt + 1}/{attempts})")
+            await asyncio.sleep(delay)
 
-def fetch_video_history(user_id):
-    response = supabase.table("video_history").select("video_url").eq("user_id", user_id).order("generated_at", desc=True).limit(10).execute()
-    return [entry["video_url"] for entry in response.data]
+    raise ProviderUnavailable(f"Runway {method} {path} still failing after {attempts} attempts: {error}")
+
+VIDEO_SIZES = {"16_9": (1344, 768), "9_16": (768, 1344), "1_1": (768, 768)}  # (width, height) per aspect ratio
 
 async def generate_video(prompt, aspect_ratio, image_url=None):
-    headers = {
-        "Authorization": f"Bearer {RUNWAY_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    """Submits a generation job and returns its ID, or None if the provider rejected it.
 
+    Raises ProviderUnavailable while the Runway circuit is open.
+    """
     payload = {
         "text_prompt": prompt,
         "model": "gen3",
@@ -109,334 +719,1357 @@ async def generate_video(prompt, aspect_ratio, image_url=None):
         "time": 5
     }
 
-    if aspect_ratio == "16_9":
-        payload["width"] = 1344
-        payload["height"] = 768
-    elif aspect_ratio == "9_16":
-        payload["width"] = 768
-        payload["height"] = 1344
-    elif aspect_ratio == "1_1":
-        payload["width"] = 768
-        payload["height"] = 768
+    if aspect_ratio in VIDEO_SIZES:
+        payload["width"], payload["height"] = VIDEO_SIZES[aspect_ratio]
 
     if image_url:
         payload["image_url"] = image_url
 
-    print(f"🟢 Sending async request with payload: {payload}")
+    log.debug(f"🟢 Sending async request with payload: {payload}")
 
-    async with aiohttp.ClientSession() as session:
+    try:
+        status, data = await runway_request("POST", "/runway/generate/text", json=payload, idempotent=False)
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        log.warning(f"⚠️ Exception during video generation: {e}")
+        return None
+
+    log.debug(f"📦 API response {status}: {data}")
+
+    if status in [200, 202] and data:
+        job_id = data.get("id")
+        log.info(f"✅ Job ID received: {job_id}")
+        return job_id
+
+    log.error(f"❌ API Error: {data}")
+    return None
+
+async def fetch_job_status(job_id):
+    """Performs a single status check for a Runway job. Returns (http_status, data)."""
+    status, data = await runway_request("GET", f"/runway/jobs/{job_id}", attempts=2)
+    if status != 200:
+        return status, None
+    return status, data
+
+# --- Job Poller ---
+POLL_TIMEOUT = 600
+POLL_FIRST_CHECK_DELAY = float(os.getenv("POLL_FIRST_CHECK_DELAY", "10"))  # give the provider time to register the job
+POLL_INITIAL_INTERVAL = float(os.getenv("POLL_INITIAL_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "10"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "1.5"))
+POLL_RATE_LIMIT = float(os.getenv("POLL_RATE_LIMIT", "5"))  # status checks per second, shared by all jobs
+POLL_MAX_ERRORS = int(os.getenv("POLL_MAX_ERRORS", "5"))  # consecutive failed checks before a job is given up
+
+class PolledJob:
+    def __init__(self, job_id, future, now, timeout):
+        self.job_id = job_id
+        self.future = future
+        self.registered_at = now
+        self.deadline = now + timeout
+        self.next_check = now + POLL_FIRST_CHECK_DELAY
+        self.interval = POLL_INITIAL_INTERVAL
+        self.polls = 0
+        self.errors = 0
+        self.status = None
+
+class JobPoller:
+    """Single background task that checks every in-flight Runway job.
+
+    Jobs are polled fast right after submission and back off towards
+    POLL_MAX_INTERVAL. All checks share one token bucket of POLL_RATE_LIMIT
+    requests per second, so API traffic stays flat no matter how many users
+    are waiting. Callers get a future that resolves to the video URL, or
+    None if the job failed or timed out.
+    """
+
+    def __init__(self, rate=POLL_RATE_LIMIT, on_status=None):
+        self.rate = rate
+        self.on_status = on_status  # called as on_status(job_id, provider_status) when a job's status changes
+        self.jobs = {}
+        self._tokens = max(rate, 1)
+        self._last_refill = None
+        self._wakeup = None
+        self._task = None
+        self._checks = set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._checks):
+            task.cancel()
+        for job in self.jobs.values():
+            if not job.future.done():
+                job.future.cancel()
+        self.jobs.clear()
+
+    def watch(self, job_id, timeout=POLL_TIMEOUT, callback=None):
+        """Registers a job and returns a future for its video URL."""
+        self.start()
+        job = self.jobs.get(job_id)
+        if job is None:
+            loop = asyncio.get_running_loop()
+            job = PolledJob(job_id, loop.create_future(), loop.time(), timeout)
+            self.jobs[job_id] = job
+            self._wakeup.set()
+        if callback:
+            job.future.add_done_callback(callback)
+        return job.future
+
+    def _resolve(self, job, video_url):
+        self.jobs.pop(job.job_id, None)
+        JOB_COMPLETION_SECONDS.labels("succeeded" if video_url else "failed").observe(asyncio.get_running_loop().time() - job.registered_at)
+        JOB_POLLS.observe(job.polls)
+        if not job.future.done():
+            job.future.set_result(video_url)
+
+    def _refill(self, now):
+        if self._last_refill is not None:
+            self._tokens = min(max(self.rate, 1), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def _check(self, job):
+        job_id_var.set(job.job_id)
+        job.polls += 1
         try:
-            async with session.post(
-                "https://api.aivideoapi.com/runway/generate/text",
-                json=payload,
-                headers=headers,
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-
-                print(f"🔁 API response: {response.status}")
-                data = await response.json()
-                print(f"📦 API JSON: {data}")
-
-                if response.status in [200, 202]:
-                    job_id = data.get("id")
-                    print(f"✅ Job ID received: {job_id}")
-                    return job_id
-                else:
-                    print(f"❌ API Error: {data}")
-                    return None
+            status, data = await fetch_job_status(job.job_id)
+        except ProviderUnavailable as e:
+            # The provider is down, not the job: keep waiting until the deadline
+            log.warning(f"⚠️ Provider unavailable while polling job {job.job_id}: {e}")
+            self._reschedule(job)
+            return
         except Exception as e:
-            print(f"⚠️ Exception during video generation: {e}")
-            return None
+            log.warning(f"⚠️ Exception while polling job {job.job_id}: {e}")
+            status, data = None, None
+
+        if data is None:
+            job.errors += 1
+            log.warning(f"⚠️ Error checking job {job.job_id} status: {status} ({job.errors}/{POLL_MAX_ERRORS})")
+            if job.errors >= POLL_MAX_ERRORS:
+                self._resolve(job, None)
+            else:
+                self._reschedule(job)
+            return
 
-async def poll_video_status(job_id, timeout=600, interval=10):
-    url = f"https://api.aivideoapi.com/runway/jobs/{job_id}"
-    headers = {
-        "Authorization": f"Bearer {RUNWAY_API_KEY}",
-        "Content-Type": "application/json"
-    }
+        job.errors = 0
+
+        log.info(f"🔁 Polling job {job.job_id} status: {data.get('status')} (poll #{job.polls})", extra=SAMPLED)
 
-    start_time = asyncio.get_event_loop().time()
+        if data.get("status") != job.status:
+            job.status = data.get("status")
+            if self.on_status:
+                self.on_status(job.job_id, job.status)
+
+        if data.get("status") == "succeeded":
+            log.info(f"✅ Job {job.job_id} completed successfully!")
+            self._resolve(job, data.get("output", {}).get("video_url"))
+        elif data.get("status") in ["failed", "cancelled"]:
+            log.warning(f"❌ Job {job.job_id} failed or was cancelled.")
+            self._resolve(job, None)
+        else:
+            self._reschedule(job)
 
-    async with aiohttp.ClientSession() as session:
+    def _reschedule(self, job):
+        job.next_check = asyncio.get_running_loop().time() + job.interval
+        job.interval = min(job.interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
         while True:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    print(f"⚠️ Error checking job status: {response.status}")
-                    return None
+            now = loop.time()
+            self._refill(now)
+
+            for job in list(self.jobs.values()):
+                if job.future.done():
+                    self.jobs.pop(job.job_id, None)
+                elif now > job.deadline:
+                    log.info(f"⏱️ Timeout reached while waiting for job {job.job_id}.")
+                    self._resolve(job, None)
+
+            due = sorted((job for job in self.jobs.values() if job.next_check <= now), key=lambda job: job.next_check)
+            batch = due[:int(self._tokens)]
+            if batch:
+                self._tokens -= len(batch)
+                for job in batch:
+                    job.next_check = float("inf")  # not due again until the check reschedules it
+                for job in batch:
+                    task = loop.create_task(self._check(job))
+                    self._checks.add(task)
+                    task.add_done_callback(self._checks.discard)
+                continue
+
+            if due:
+                delay = (1 - self._tokens) / self.rate
+            elif self.jobs:
+                delay = min(min(job.next_check for job in self.jobs.values()),
+                            min(job.deadline for job in self.jobs.values())) - now
+            else:
+                delay = None
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=None if delay is None else max(delay, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+def on_job_status(job_id, status):
+    if status not in ["succeeded", "failed", "cancelled"]:
+        asyncio.get_running_loop().create_task(record_job_status(job_id, "running"))
+
+job_poller = JobPoller(on_status=on_job_status)
+
+async def poll_video_status(job_id, timeout=POLL_TIMEOUT):
+    # Shielded so a cancelled waiter doesn't cancel the shared future
+    return await asyncio.shield(job_poller.watch(job_id, timeout=timeout))
+
+# --- Generation scheduler ---
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "5"))  # provider jobs in flight at once
+GENERATION_PER_USER = int(os.getenv("GENERATION_PER_USER", "1"))  # in-flight jobs per user
+
+class GenerationScheduler:
+    """Limits how many generations run at once, globally and per user.
+
+    Waiting requests sit in one FIFO per user, and freed slots go to users
+    round-robin. A user with many queued prompts can't starve everyone
+    else, and their own prompts still run in the order they sent them.
+    """
+
+    def __init__(self, limit=GENERATION_CONCURRENCY, per_user=GENERATION_PER_USER):
+        self.limit = limit
+        self.per_user = per_user
+        self.running = 0
+        self.in_flight = {}  # user_id -> running generations
+        self.queues = OrderedDict()  # user_id -> deque of waiting futures, in round-robin order
+
+    def waiting(self):
+        return sum(len(waiters) for waiters in self.queues.values())
+
+    def position(self, future):
+        """1-based position of a waiting request in round-robin order."""
+        queues = list(self.queues.values())
+        position = 0
+        for depth in range(max((len(waiters) for waiters in queues), default=0)):
+            for waiters in queues:
+                if depth < len(waiters):
+                    position += 1
+                    if waiters[depth] is future:
+                        return position
+        return position
+
+    async def acquire(self, user_id, on_queued=None):
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append(future)
+        self._dispatch()
+        if future.done():
+            return
+
+        if on_queued:
+            try:
+                await on_queued(self.position(future))
+            except Exception as e:
+                log.warning(f"⚠️ Could not send queue position to {user_id}: {e}")
 
-                data = await response.json()
-                print(f"🔁 Polling job {job_id} status: {data.get('status')}")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(user_id)  # the slot was granted just as we were cancelled
+            else:
+                self._discard(user_id, future)
+            raise
+
+    def release(self, user_id):
+        self.running -= 1
+        self.in_flight[user_id] -= 1
+        if not self.in_flight[user_id]:
+            del self.in_flight[user_id]
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, on_queued=None):
+        await self.acquire(user_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def _discard(self, user_id, future):
+        queue = self.queues.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.queues[user_id]
+
+    def _dispatch(self):
+        while self.running < self.limit:
+            user_id = next((uid for uid in self.queues if self.in_flight.get(uid, 0) < self.per_user), None)
+            if user_id is None:
+                return
 
-                if data.get("status") == "succeeded":
-                    print(f"✅ Job {job_id} completed successfully!")
-                    return data.get("output", {}).get("video_url")
-                elif data.get("status") in ["failed", "cancelled"]:
-                    print(f"❌ Job {job_id} failed or was cancelled.")
-                    return None
+            queue = self.queues.pop(user_id)
+            future = queue.popleft()
+            if queue:
+                self.queues[user_id] = queue  # back of the rotation
+            if future.done():
+                continue
+
+            self.running += 1
+            self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+            future.set_result(None)
+
+generation_scheduler = GenerationScheduler()
+
+active_deliveries = set()
+pending_requests = set()  # (request key, user ID) of requests charged but not yet handed to delivery
+
+# --- Video delivery ---
+# Finished videos are handed to a small pool of delivery workers, so the
+# interaction (and its scheduler slot) is released as soon as the provider
+# is done. A worker streams the file to disk in chunks, keeps a durable copy
+# in Supabase Storage when VIDEO_BUCKET is set (provider URLs expire), and
+# attaches the file to the DM when it fits under Discord's upload limit.
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "3"))
+DISCORD_UPLOAD_LIMIT = int(os.getenv("DISCORD_UPLOAD_LIMIT", str(10 * 1024 * 1024)))
+VIDEO_BUCKET = os.getenv("VIDEO_BUCKET")  # unset: no re-hosting, history keeps the expiring provider URL (warned at startup)
+VIDEO_MAX_BYTES = 200 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_read=60)
+
+async def download_video(url, path):
+    """Streams a video to path without holding it in memory. Returns its size in bytes."""
+    size = 0
+    async with get_http_session().get(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > VIDEO_MAX_BYTES:
+                    raise ValueError(f"video is larger than {VIDEO_MAX_BYTES} bytes")
+                file.write(chunk)
+    return size
+
+def upload_video(path, key):
+    bucket = get_supabase().storage.from_(VIDEO_BUCKET)
+    bucket.upload(key, path, {"content-type": "video/mp4", "upsert": "true"})
+    return bucket.get_public_url(key)
+
+# --- Image preprocessing ---
+# Input images for image+text generations are checked and prepared before
+# any credits are spent: the attachment is streamed with its type and size
+# checked from the headers, cropped and scaled to the video size in a
+# process pool (decoding is CPU-bound), and re-hosted as a JPEG so the
+# provider gets a small image that already has the right shape. Without a
+# bucket there is nowhere to re-host, so only the image header is checked.
+IMAGE_TYPES = ["image/png", "image/jpeg", "image/webp"]
+IMAGE_FORMATS = ["PNG", "JPEG", "WEBP"]  # as reported by Pillow
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = 40_000_000
+IMAGE_JPEG_QUALITY = 90
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_BUCKET = os.getenv("IMAGE_BUCKET", VIDEO_BUCKET)  # unset: no resizing, the provider gets the original attachment URL
+IMAGE_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_read=20)
+image_executor = None  # started on the first image, see get_image_executor
+
+def get_image_executor():
+    # By then the log listener, watchdog and executor threads are running, and
+    # forking a threaded process can leave a child stuck on a lock one of them
+    # held. Workers come from a fork server instead (spawn where there is
+    # none); they import bot.py, which is safe now that importing has no
+    # side effects.
+    global image_executor
+    if image_executor is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context(method))
+    return image_executor
+
+class ImageRejected(Exception):
+    """An input image we can't use. The message is shown to the user."""
+
+async def download_image(url):
+    async with get_http_session().get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        if response.content_type not in IMAGE_TYPES:
+            raise ImageRejected("⚠️ Please attach a PNG, JPEG or WebP image.")
+        if (response.content_length or 0) > IMAGE_MAX_BYTES:
+            raise ImageRejected(f"⚠️ That image is too large (max {IMAGE_MAX_BYTES // (1024 * 1024)} MB).")
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            data += chunk
+            if len(data) > IMAGE_MAX_BYTES:
+                raise ImageRejected(f"⚠️ That image is too large (max {IMAGE_MAX_BYTES // (1024 * 1024)} MB).")
+    return bytes(data)
+
+def check_image(image):
+    """Rejects an opened image from its header alone; nothing has been decoded yet."""
+    if image.format not in IMAGE_FORMATS:
+        raise ValueError(f"unsupported image format {image.format}")
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise ValueError(f"image is {image.width}x{image.height}")
+
+def prepare_image(data, width, height):
+    """Crops and scales an image to width x height and returns it as JPEG bytes. Runs in image_executor."""
+    with Image.open(io.BytesIO(data)) as image:
+        check_image(image)
+        side = max(width, height)
+        image.draft("RGB", (side, side))  # JPEGs are decoded straight at a reduced scale
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image.convert("RGB"), (width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+def upload_image(data, key):
+    bucket = get_supabase().storage.from_(IMAGE_BUCKET)
+    bucket.upload(key, data, {"content-type": "image/jpeg", "upsert": "true"})
+    return bucket.get_public_url(key)
+
+async def prepare_input_image(attachment, aspect_ratio):
+    """Returns the URL of a prepared copy of a Discord attachment. Raises ImageRejected."""
+    if attachment.content_type and attachment.content_type not in IMAGE_TYPES:
+        raise ImageRejected("⚠️ Please attach a PNG, JPEG or WebP image.")
+    if attachment.size > IMAGE_MAX_BYTES:
+        raise ImageRejected(f"⚠️ That image is too large (max {IMAGE_MAX_BYTES // (1024 * 1024)} MB).")
+
+    data = await download_image(attachment.url)
+    width, height = VIDEO_SIZES[aspect_ratio]
+    try:
+        if not IMAGE_BUCKET:
+            # Nowhere to host a resized copy, so only check the header and pass the original on
+            with Image.open(io.BytesIO(data)) as image:
+                check_image(image)
+            return attachment.url
+        prepared = await run_blocking(prepare_image, data, width, height, executor=get_image_executor())
+    except (ValueError, OSError, Image.DecompressionBombError) as e:
+        log.info(f"🖼️ Rejected input image {attachment.filename}: {e}")
+        raise ImageRejected("⚠️ That image couldn't be read. Please attach a PNG, JPEG or WebP image.") from e
+
+    # Content-addressed, so the same image gets the same URL (and the same result cache key)
+    key = f"inputs/{hashlib.sha256(prepared).hexdigest()}.jpg"
+    return await run_blocking(upload_image, prepared, key)
+
+async def send_followup(interaction, content):
+    """Best effort: the interaction token expires 15 minutes after the click, which queueing and polling can outlast."""
+    try:
+        await interaction.followup.send(content, ephemeral=True)
+        return True
+    except discord.HTTPException as e:
+        log.warning(f"⚠️ Could not send followup to {interaction.user.id}: {e}")
+        return False
 
-            # Check timeout
-            if asyncio.get_event_loop().time() - start_time > timeout:
-                print("⏱️ Timeout reached while waiting for video.")
-                return None
+async def send_video(user_id, video_url, interaction=None, file_path=None):
+    message = f"🎥 Your video is ready! Click here: {video_url}"
+    try:
+        user = interaction.user if interaction else await bot.fetch_user(int(user_id))
+        if file_path:
+            await user.send(message, file=discord.File(file_path, filename="kolde-video.mp4"))
+        else:
+            await user.send(message)
+    except discord.Forbidden:
+        log.warning(f"⚠️ Cannot DM user {user_id} — DMs disabled.")
+    except Exception as e:
+        log.error(f"❌ Failed to send DM: {e}")
+    else:
+        log.info(f"📬 Sent DM to {user.name} ({user.id})")
+        if interaction:
+            await send_followup(interaction, "✅ Video sent to your DMs!")
+        return True
 
-            await asyncio.sleep(interval)
+    # No DM, so the followup is the delivery; if that fails too, the next startup retries
+    return interaction is not None and await send_followup(interaction, message)
 
-def init_db():
+async def deliver_video(job_id, user_id, provider_url, prompt, interaction=None, cache_key=None):
+    """Sends a finished video. job_id is None for results served from the result cache."""
+    job_id_var.set(job_id)
+    fd, path = tempfile.mkstemp(suffix=".mp4", prefix="kolde-")
+    os.close(fd)
     try:
-        # Supabase doesn't support table creation via client, so just validate with a test query
-        # Optional: Insert dummy rows to ensure the table structure works
+        video_url, attach = provider_url, False
+        try:
+            size = await download_video(provider_url, path)
+            if VIDEO_BUCKET and job_id:
+                video_url = await run_blocking(upload_video, path, f"{user_id}/{job_id}.mp4")
+            attach = size <= DISCORD_UPLOAD_LIMIT
+        except Exception as e:
+            log.warning(f"⚠️ Could not re-host video for job {job_id}, sending the provider link: {e}")
+        if cache_key and video_url != provider_url:
+            result_cache.put(cache_key, video_url)  # prefer the durable copy for later hits
+
+        if not await send_video(user_id, video_url, interaction, file_path=path if attach else None):
+            return  # stays "succeeded" so the next startup retries delivery
+    finally:
+        os.remove(path)
 
-        # Test user_credits table
-        supabase.table("user_credits").select("user_id, credits").limit(1).execute()
+    # Save to history
+    await record_video(user_id, video_url, prompt)
+    if job_id:
+        await record_job_status(job_id, "delivered", user_id=user_id)
+
+class DeliveryPool:
+    def __init__(self, workers=DELIVERY_WORKERS):
+        self.workers = workers
+        self.queue = None
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
 
-        # Test video_history table
-        supabase.table("video_history").select("user_id, video_url, generated_at").limit(1).execute()
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
-        print("✅ Tables are accessible and seem to exist.")
+    def pending(self):
+        return self.queue.qsize() if self.queue else 0
+
+    def submit(self, job_id, user_id, video_url, prompt, interaction=None, cache_key=None):
+        self.start()
+        self.queue.put_nowait((job_id, user_id, video_url, prompt, interaction, cache_key))
+
+    async def _worker(self):
+        while True:
+            job_id, user_id, video_url, prompt, interaction, cache_key = await self.queue.get()
+            try:
+                await deliver_video(job_id, user_id, video_url, prompt, interaction, cache_key)
+            except Exception as e:
+                log.error(f"❌ Delivery of job {job_id} failed: {e}")
+            finally:
+                active_deliveries.discard((job_id, str(user_id)))
+                self.queue.task_done()
+
+delivery_pool = DeliveryPool()
+
+async def deliver_job(job_id, user_id, prompt, interaction=None, video_url=None, cache_key=None):
+    """Waits for a job (unless its video_url is already known) and hands the result to the delivery pool."""
+    key = (job_id, str(user_id))
+    if key in active_deliveries:
+        return
+    active_deliveries.add(key)
+    job_id_var.set(job_id)
+    handed_off = False
+    try:
+        if not video_url:
+            video_url = await poll_video_status(job_id, timeout=POLL_TIMEOUT)
+        if cache_key:
+            result_cache.finish(cache_key, video_url)
+
+        if not video_url:
+            log.error("❌ Video generation failed or timed out.")
+            await record_job_status(job_id, "failed", user_id=user_id)
+            if interaction:
+                await send_followup(interaction, "❌ Failed to generate video. Please try again later.")
+            return
+
+        await record_job_status(job_id, "succeeded", video_url, user_id=user_id)
+        delivery_pool.submit(job_id, user_id, video_url, prompt, interaction, cache_key)
+        handed_off = True
+    finally:
+        if not handed_off:
+            active_deliveries.discard(key)
+
+async def resume_jobs():
+    """Picks up polling and delivery for jobs that were in flight when the bot last stopped."""
+    try:
+        jobs = await run_blocking(fetch_unfinished_jobs)
+    except Exception as e:
+        log.warning(f"⚠️ Could not load unfinished jobs: {e}")
+        return
+
+    for job in jobs:
+        if (job["job_id"], str(job["user_id"])) in active_deliveries:
+            continue
+        log.info(f"♻️ Resuming job {job['job_id']} ({job['status']}) for user {job['user_id']}")
+        video_url = job.get("video_url") if job["status"] == "succeeded" else None
+        asyncio.create_task(deliver_job(job["job_id"], job["user_id"], job.get("prompt"), video_url=video_url))
+
+def fetch_queued_jobs(limit=BULK_CREDIT_BATCH_SIZE):
+    return get_supabase().table("generation_jobs").select("job_id, user_id, credits").eq("status", "queued").limit(limit).execute().data
+
+def fail_queued_jobs(jobs):
+    """Marks queued requests failed and returns the ones that were charged.
+
+    A request is charged after its row is written, so a row without a
+    "generation" ledger entry keeps no credits and isn't refunded.
+    """
+    request_ids = [job["job_id"] for job in jobs]
+    ledger = get_supabase().table("credit_transactions").select("reference").eq("reason", "generation").in_("reference", request_ids).execute().data
+    charged_ids = {row["reference"] for row in ledger}
+    charged = [job for job in jobs if job["job_id"] in charged_ids]
+    update = {"status": "failed", "updated_at": datetime.utcnow().isoformat()}
+    if charged:
+        get_supabase().table("generation_jobs").update(update).in_("job_id", list(charged_ids)).execute()
+    uncharged_ids = [request_id for request_id in request_ids if request_id not in charged_ids]
+    if uncharged_ids:
+        get_supabase().table("generation_jobs").update({**update, "credits": 0}).in_("job_id", uncharged_ids).execute()
+    return charged
+
+async def release_queued_jobs():
+    """Fails and refunds requests that were still waiting for the provider when the bot last stopped.
+
+    A refund that doesn't go through here is left to /refund_failed, which
+    checks the same ledger references.
+    """
+    refunded = 0
+    try:
+        while True:
+            jobs = await run_blocking(fetch_queued_jobs)
+            if not jobs:
+                break
+            charged = await run_blocking(fail_queued_jobs, jobs)
+            refunds = await run_blocking(unrefunded_jobs, charged) if charged else []
+            if refunds:
+                await bulk_add_credits([{"user_id": job["user_id"], "delta": job["credits"], "reference": refund_reference(job)}
+                                        for job in refunds], "refund")
+                refunded += len(refunds)
     except Exception as e:
-        print("❌ Error accessing Supabase tables! Make sure 'user_credits' and 'video_history' exist.")
-        print(e)
+        log.warning(f"⚠️ Could not release queued requests: {e}")
+    if refunded:
+        log.info(f"↩️ Refunded {refunded} requests that were still queued when the bot stopped")
+
+# --- Result cache ---
+# Requests are content-addressed by their normalized payload. The provider is
+# called with a fixed seed, so the same payload gives the same video: a
+# recent result is re-sent instead of paying for a new job, and identical
+# requests that arrive while a job is running share that job.
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "500"))
+
+def request_key(prompt, aspect_ratio, image_url=None):
+    normalized = {"prompt": " ".join(prompt.split()), "aspect_ratio": aspect_ratio, "image_url": image_url}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    def __init__(self, ttl=RESULT_CACHE_TTL, maxsize=RESULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.results = OrderedDict()  # key -> (video_url, expires_at)
+        self.inflight = {}  # key -> future resolving to the provider job_id (None if submission failed)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        entry = self.results.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.results.pop(key, None)
+            self.misses += 1
+            return None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, video_url):
+        self.results[key] = (video_url, time.monotonic() + self.ttl)
+        self.results.move_to_end(key)
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+    def pending(self, key):
+        return self.inflight.get(key)
+
+    def begin(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+    def submitted(self, key, future, job_id):
+        if not future.done():
+            future.set_result(job_id)
+        if not job_id and self.inflight.get(key) is future:
+            del self.inflight[key]
+
+    def finish(self, key, video_url):
+        self.inflight.pop(key, None)
+        if video_url and key not in self.results:
+            self.put(key, video_url)
+
+result_cache = ResultCache()
+
+async def start_delivery(interaction, job_id, request_id, prompt, cache_key):
+    user = interaction.user
+    try:
+        await run_blocking(assign_job, request_id, user.id, job_id)
+    except Exception as e:
+        log.warning(f"⚠️ Could not persist job {job_id} for request {request_id}: {e}")
+
+    await send_followup(interaction, "⏳ Video generation started. Waiting for completion...")
+    await deliver_job(job_id, user.id, prompt, interaction, cache_key=cache_key)
+
+async def join_inflight(interaction, pending, request_id, prompt, cache_key):
+    job_id = await asyncio.shield(pending)
+    if not job_id:
+        return False
+    result_cache.coalesced += 1
+    log.info(f"🔗 Joining in-flight job {job_id} for identical request {cache_key[:12]}")
+    await start_delivery(interaction, job_id, request_id, prompt, cache_key)
+    return True
+
+async def run_generation(interaction, request_id, prompt, ratio, image_url, required_credits):
+    """Gets a video for a paid request: from the result cache, by joining an identical running job, or by submitting a new one."""
+    user = interaction.user
+    cache_key = request_key(prompt, ratio, image_url)
+
+    cached_url = result_cache.get(cache_key)
+    if cached_url:
+        log.info(f"⚡ Result cache hit for {cache_key[:12]}")
+        await record_job_status(request_id, "delivered", cached_url, user_id=user.id)
+        delivery_pool.submit(None, user.id, cached_url, prompt, interaction)
+        return
+
+    pending = result_cache.pending(cache_key)
+    if pending is not None and await join_inflight(interaction, pending, request_id, prompt, cache_key):
+        return
+
+    async def notify_queued(position):
+        await interaction.followup.send(f"🕒 The generator is busy — you are **#{position}** in the queue.", ephemeral=True)
+
+    async with generation_scheduler.slot(user.id, on_queued=notify_queued):
+        pending = result_cache.pending(cache_key)
+        if pending is None:
+            future = result_cache.begin(cache_key)
+            job_id = None
+            try:
+                job_id = await generate_video(prompt, ratio, image_url)
+            except ProviderUnavailable as e:
+                log.warning(f"⚠️ {e}")
+            finally:
+                result_cache.submitted(cache_key, future, job_id)
+            log.debug(f"🔁 generate_video() returned job_id: {job_id}")
+
+            if job_id:
+                await start_delivery(interaction, job_id, request_id, prompt, cache_key)
+                return
+
+    # Either our submission failed, or an identical request was submitted while we were queued
+    if pending is not None and await join_inflight(interaction, pending, request_id, prompt, cache_key):
+        return
+
+    await record_job_status(request_id, "failed", user_id=user.id)
+    await add_credits(user.id, required_credits, reason="refund", reference=refund_reference({"job_id": request_id, "user_id": user.id}))
+    await send_followup(interaction, "❌ Failed to start video generation. Your credits were refunded, please try again.")
+
+# --- Stripe fulfillment ---
+# webhook.py only verifies and stores Stripe events (stripe_events table,
+# keyed by event ID). This worker claims pending events and applies them.
+# Claiming is a compare-and-set on status, and credit top-ups carry the event
+# ID as their ledger reference, which the ledger accepts once per purchase,
+# so each purchase is applied exactly once even if the bot dies halfway
+# through an event or two workers get hold of it.
+ACCESS_INCLUDED_CREDITS = 10  # "Acces (include 10 credite)"
+FULFILLMENT_POLL_INTERVAL = float(os.getenv("FULFILLMENT_POLL_INTERVAL", "5"))
+FULFILLMENT_BATCH_SIZE = 20
+FULFILLMENT_MAX_ATTEMPTS = 5
+
+def fetch_pending_events(limit=FULFILLMENT_BATCH_SIZE):
+    response = get_supabase().table("stripe_events").select("*").eq("status", "pending").order("received_at").limit(limit).execute()
+    return response.data
+
+def claim_event(event_id):
+    response = get_supabase().table("stripe_events").update({"status": "processing"}).eq("event_id", event_id).eq("status", "pending").execute()
+    return bool(response.data)
+
+def finish_event(event_id, status, attempts=None, error=None):
+    update = {"status": status, "processed_at": datetime.utcnow().isoformat()}
+    if attempts is not None:
+        update["attempts"] = attempts
+    if error is not None:
+        update["last_error"] = error
+    get_supabase().table("stripe_events").update(update).eq("event_id", event_id).execute()
+
+def release_stale_events():
+    """Returns events left in 'processing' by a previous run to the queue."""
+    get_supabase().table("stripe_events").update({"status": "pending"}).eq("status", "processing").execute()
+
+async def grant_access(user_id):
+    """Grants the Discord role to the user after payment."""
+    guild = bot.get_guild(GUILD_ID)
+    if guild is None:
+        raise RuntimeError(f"Guild {GUILD_ID} is not available")
+    role = guild.get_role(ACCESS_ROLE_ID)
+    if role is None:
+        raise RuntimeError(f"Access role {ACCESS_ROLE_ID} not found")
+    member = guild.get_member(user_id) or await guild.fetch_member(user_id)
+    if member.get_role(ACCESS_ROLE_ID) is None:
+        await member.add_roles(role, reason="Stripe payment")
+    access_index.grant(user_id)
+    log.info(f"✅ Granted access role to {member.name}")
+
+async def apply_purchase_credits(user_id, amount, reference):
+    if await add_credits(user_id, amount, reason="purchase", reference=reference) is None:
+        log.info(f"↩️ Credits for {reference} were already applied, skipping.")
+
+async def fulfill_event(event):
+    session = event["payload"]
+    metadata = session.get("metadata") or {}
+    if session.get("payment_status") not in [None, "paid", "no_payment_required"]:
+        log.warning(f"⚠️ Skipping Stripe event {event['event_id']}: payment status {session.get('payment_status')}")
+        return
+
+    user_id = int(metadata["user_id"])
+    purchase_type = metadata.get("type")
+
+    if purchase_type == "access":
+        access_checkout_cache.pop(user_id, None)  # that session is paid now, don't hand it out again
+        await grant_access(user_id)
+        await apply_purchase_credits(user_id, ACCESS_INCLUDED_CREDITS, event["event_id"])
+    elif purchase_type == "credits":
+        await apply_purchase_credits(user_id, int(metadata["credit_amount"]), event["event_id"])
+    else:
+        log.warning(f"⚠️ Unknown purchase type in Stripe event {event['event_id']}: {purchase_type}")
+
+class FulfillmentWorker:
+    def __init__(self, interval=FULFILLMENT_POLL_INTERVAL):
+        self.interval = interval
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wakeup(self):
+        """Processes pending events now instead of at the next interval."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def process_pending(self):
+        events = await run_blocking(fetch_pending_events)
+        for event in events:
+            if not await run_blocking(claim_event, event["event_id"]):
+                continue  # another worker got it first
+            attempts = (event.get("attempts") or 0) + 1
+            try:
+                await fulfill_event(event)
+            except Exception as e:
+                status = "failed" if attempts >= FULFILLMENT_MAX_ATTEMPTS else "pending"
+                log.error(f"❌ Fulfillment of Stripe event {event['event_id']} failed ({attempts}/{FULFILLMENT_MAX_ATTEMPTS}): {e}")
+                await run_blocking(finish_event, event["event_id"], status, attempts, str(e))
+            else:
+                await run_blocking(finish_event, event["event_id"], "processed", attempts)
+                log.info(f"💳 Processed Stripe event {event['event_id']}")
+        return len(events)
+
+    async def _run(self):
+        try:
+            await run_blocking(release_stale_events)
+        except Exception as e:
+            log.warning(f"⚠️ Could not release stale Stripe events: {e}")
+
+        while True:
+            try:
+                processed = await self.process_pending()
+            except Exception as e:
+                log.warning(f"⚠️ Stripe fulfillment loop error: {e}")
+                processed = 0
+            if processed >= FULFILLMENT_BATCH_SIZE:
+                continue  # more waiting, don't sleep
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+fulfillment_worker = FulfillmentWorker()
+
+# --- Health probes ---
+# One cheap read per table bot.py relies on (Supabase doesn't support table
+# creation via the client, so schema.sql has to be run by hand). They all run
+# at once on db_executor, so startup waits for the slowest probe only.
+HEALTH_PROBES = {
+    "user_credits": "user_id, credits, updated_at",
+    "video_history": "user_id, video_url, generated_at",
+    "credit_transactions": "user_id, delta",
+    "generation_jobs": "job_id, status",
+    "stripe_events": "event_id, status",
+}
+
+def probe_table(table, columns):
+    get_supabase().table(table).select(columns).limit(1).execute()
+
+async def run_health_probes():
+    """Returns {table: None if it is accessible, else the error}."""
+    async def probe(table, columns):
+        try:
+            await run_blocking(probe_table, table, columns)
+        except Exception as e:
+            return str(e)
+        return None
+
+    results = await asyncio.gather(*(probe(table, columns) for table, columns in HEALTH_PROBES.items()))
+    failed = {table: error for table, error in zip(HEALTH_PROBES, results) if error}
+    if failed:
+        log.error(f"❌ Error accessing Supabase tables! Run schema.sql and make sure {', '.join(map(repr, HEALTH_PROBES))} exist. {failed}")
+    else:
+        log.info("✅ Tables are accessible and seem to exist.")
+    return dict(zip(HEALTH_PROBES, results))
+
+# --- Access index ---
+class AccessIndex:
+    """Which users hold ACCESS_ROLE_ID, as a pair of sets.
+
+    Entries are filled lazily: from the member object that comes with each
+    interaction, or by fetching the member when we have nothing else. Member
+    and role events and Stripe grants keep them current. Because of this
+    the bot never has to chunk the whole guild's member list.
+    """
+
+    def __init__(self):
+        self.entitled = set()
+        self.known = set()
+
+    def lookup(self, user_id):
+        """True/False if we know the user's access, None if we have to look it up."""
+        if user_id not in self.known:
+            return None
+        return user_id in self.entitled
+
+    def observe(self, member):
+        if member.get_role(ACCESS_ROLE_ID) is not None:
+            self.grant(member.id)
+            return True
+        self.revoke(member.id)
+        return False
+
+    def grant(self, user_id):
+        self.known.add(user_id)
+        self.entitled.add(user_id)
+
+    def revoke(self, user_id):
+        self.known.add(user_id)
+        self.entitled.discard(user_id)
+
+    def forget(self, user_id):
+        self.known.discard(user_id)
+        self.entitled.discard(user_id)
+
+    def clear(self):
+        self.known.clear()
+        self.entitled.clear()
+
+access_index = AccessIndex()
+
+async def check_access(user):
+    # Interaction payloads carry the member's current roles, so use them when we have them
+    if isinstance(user, discord.Member):
+        return access_index.observe(user)
+
+    cached = access_index.lookup(user.id)
+    if cached is not None:
+        return cached
+
+    guild = bot.get_guild(GUILD_ID)
+    if guild is None:
+        return False
+    try:
+        member = guild.get_member(user.id) or await guild.fetch_member(user.id)
+    except discord.NotFound:
+        access_index.revoke(user.id)
+        return False
+    except discord.HTTPException as e:
+        log.warning(f"⚠️ Could not fetch member {user.id}: {e}")
+        return False
+    return access_index.observe(member)
 
 intents = discord.Intents.default()
-intents.message_content = True
 intents.guilds = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class KoldeBot(commands.Bot):
+    async def setup_hook(self):
+        # Runs once per process, before the gateway connects; see Startup for the rest
+        loop_monitor.start()
+        await start_http_server()
+
+        # Menu buttons are stateless, so one registered instance of each menu
+        # handles clicks on every copy, including messages sent before a restart
+        for menu in (MainMenu(), FullFunctionMenu(), VideoRatioMenu()):
+            self.add_view(menu)
+
+        # Commands registered by the previous deploy keep working while this runs,
+        # so the gateway connection doesn't wait for it
+        self.sync_task = asyncio.create_task(self.sync_commands())
+
+    async def sync_commands(self):
+        # Sync slash commands to the home guild only, so changes show up immediately
+        guild = discord.Object(id=GUILD_ID)
+        self.tree.copy_global_to(guild=guild)
+        try:
+            await self.tree.sync(guild=guild)
+        except discord.HTTPException as e:
+            log.warning(f"⚠️ Could not sync slash commands: {e}")
+
+    async def close(self):
+        await startup.stop()
+        await loop_monitor.stop()
+        await job_poller.stop()
+        await delivery_pool.stop()
+        await fulfillment_worker.stop()
+        await stop_http_server()
+        await close_http_session()
+        db_executor.shutdown(wait=False)
+        stripe_executor.shutdown(wait=False)
+        if image_executor is not None:
+            image_executor.shutdown(wait=False)
+        await super().close()
+
+# Members are resolved lazily (see AccessIndex), so skip chunking the whole guild on startup.
+# Without the message_content intent, prefix commands only work in DMs or when mentioning the bot.
+bot = KoldeBot(command_prefix=commands.when_mentioned_or("!"), intents=intents, chunk_guilds_at_startup=False)
+
+class MenuButton(discord.ui.Button):
+    dispatchable = True
+
+    def is_dispatchable(self):
+        return self.dispatchable and super().is_dispatchable()
 
-# --- Main Menu ---
-class MainMenu(discord.ui.View):
+    async def callback(self, interaction: discord.Interaction):
+        await dispatch_component(interaction)
+
+class PersistentMenu(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
-        self.add_item(discord.ui.Button(label="🔓 Login", style=discord.ButtonStyle.blurple, custom_id="login"))
-        self.add_item(discord.ui.Button(label="🔒 Get Access", style=discord.ButtonStyle.red, custom_id="get_access"))
+
+    @classmethod
+    def render(cls):
+        """A copy of the menu for sending; clicks on it go to the instance registered in setup_hook.
+
+        discord.py stores the view passed to response.send_message and
+        channel.send under the same keys as that instance, even when it is
+        stopped, and drops those keys when an ephemeral copy times out. So
+        the copy's buttons are not dispatchable and the store never sees
+        them. It is also stopped, so followup.send and message.edit don't
+        store it at all.
+        """
+        view = cls()
+        for item in view.children:
+            if isinstance(item, MenuButton):
+                item.dispatchable = False
+        view.stop()
+        return view
+
+# --- Main Menu ---
+class MainMenu(PersistentMenu):
+    def __init__(self):
+        super().__init__()
+        self.add_item(MenuButton(label="🔓 Login", style=discord.ButtonStyle.blurple, custom_id="login"))
+        self.add_item(MenuButton(label="🔒 Get Access", style=discord.ButtonStyle.red, custom_id="get_access"))
         self.add_item(discord.ui.Button(label="📄 Prompt Guide", url="https://docs.google.com/document/d/13oxxQQvtHuHqdvIv5i6yIOgGldXGQk9AuGAeUiTlM4o/edit?usp=sharing", style=discord.ButtonStyle.link))
 
 # --- Full Function Menu ---
-class FullFunctionMenu(discord.ui.View):
+class FullFunctionMenu(PersistentMenu):
     def __init__(self):
-        super().__init__(timeout=None)
-        self.add_item(discord.ui.Button(label="🎥 Video by Text Prompt", style=discord.ButtonStyle.green, custom_id="video_text"))
-        self.add_item(discord.ui.Button(label="🖼️ Video by Image + Text", style=discord.ButtonStyle.green, custom_id="video_image"))
-        self.add_item(discord.ui.Button(label="📜 View History", style=discord.ButtonStyle.blurple, custom_id="history"))
-        self.add_item(discord.ui.Button(label="💳 Buy Credits", style=discord.ButtonStyle.green, custom_id="buy_credits"))
-        self.add_item(discord.ui.Button(label="💼 Check Credits", style=discord.ButtonStyle.gray, custom_id="check_credits"))
-        self.add_item(discord.ui.Button(label="🔄 Refresh Menu", style=discord.ButtonStyle.gray, custom_id="refresh"))
+        super().__init__()
+        self.add_item(MenuButton(label="🎥 Video by Text Prompt", style=discord.ButtonStyle.green, custom_id="video_text"))
+        self.add_item(MenuButton(label="🖼️ Video by Image + Text", style=discord.ButtonStyle.green, custom_id="video_image"))
+        self.add_item(MenuButton(label="📜 View History", style=discord.ButtonStyle.blurple, custom_id="history"))
+        self.add_item(MenuButton(label="💳 Buy Credits", style=discord.ButtonStyle.green, custom_id="buy_credits"))
+        self.add_item(MenuButton(label="💼 Check Credits", style=discord.ButtonStyle.gray, custom_id="check_credits"))
+        self.add_item(MenuButton(label="🔄 Refresh Menu", style=discord.ButtonStyle.gray, custom_id="refresh"))
 
 # --- Payment Menu ---
-class PaymentMenu(discord.ui.View):
+class PaymentMenu(PersistentMenu):
     def __init__(self):
-        super().__init__(timeout=None)
+        super().__init__()
         self.add_item(discord.ui.Button(label="💰 Buy Access", url="https://example.com/buy", style=discord.ButtonStyle.link))
 
 # --- Video Ratio Selection Menu ---
-class VideoRatioMenu(discord.ui.View):
-    def __init__(self, interaction: discord.Interaction, video_type: str):
-        super().__init__(timeout=60)
+class VideoRatioMenu(PersistentMenu):
+    def __init__(self, video_type: str = "video_text"):
+        super().__init__()
         self.add_item(RatioButton("16:9", f"ratio_16_9_{video_type}"))
         self.add_item(RatioButton("9:16", f"ratio_9_16_{video_type}"))
         self.add_item(RatioButton("1:1", f"ratio_1_1_{video_type}"))
 
-class RatioButton(discord.ui.Button):
+class RatioButton(MenuButton):
     def __init__(self, label: str, custom_id: str):
         super().__init__(label=label, style=discord.ButtonStyle.primary, custom_id=custom_id)
 
-    async def callback(self, interaction: discord.Interaction):
-        if not interaction.response.is_done:  # Remove the await
-            await interaction.response.defer(ephemeral=True)
-        
-import discord
-import asyncio
-
-@bot.event
-async def on_interaction(interaction: discord.Interaction):
-    job_id = None
-    prompt = None
-    image_url = None
-    user = interaction.user
-    guild = interaction.guild
-    member = guild.get_member(user.id) if guild else None
-    has_access = any(role.id == ACCESS_ROLE_ID for role in member.roles) if member else False
-
-    custom_id = interaction.data.get("custom_id", "")
-
-    print(f"Interaction received: {custom_id}")  # Debugging
+# --- Input Modals ---
+# discord.py looks up open modals by custom_id alone, so each instance gets a unique suffix
+def modal_id(name):
+    return f"{name}:{os.urandom(8).hex()}"
 
-    defer_needed = custom_id in ["video_text", "video_image", "ratio_16_9", "ratio_9_16", "check_credits", "history"]
+class BuyCreditsModal(discord.ui.Modal, title="💳 Buy Credits"):
+    quantity = discord.ui.TextInput(label=f"How many credits? (min {MIN_CREDITS})", placeholder="10", max_length=6)
 
-    if defer_needed and not interaction.response.is_done():
-        try:
-            await interaction.response.defer(ephemeral=True)
-        except discord.errors.NotFound:
-            print("Interaction expired before deferring.")
-            return
-
-    if custom_id == "get_access":
-        session_url = create_checkout_session(user.id)
-        await interaction.response.send_message(
-            "🔒 You need access! Click below to purchase:",
-            view=discord.ui.View().add_item(
-                discord.ui.Button(label="💰 Buy Access", style=discord.ButtonStyle.link, url=session_url)
-            ),
-            ephemeral=True
-        )
-        return
-
-    if custom_id == "login":
-        await interaction.response.send_message(
-            "✅ You now have access to all functions!" if has_access else "🔒 You need access! Choose a payment method below:",
-            view=FullFunctionMenu() if has_access else PaymentMenu(),
-            ephemeral=True
-        )
-        return
-
-    if custom_id == "check_credits":
-        credits = get_credits(user.id)
-        await interaction.followup.send(f"💼 You have **{credits}** credits.", ephemeral=True)
-        return
-
-    if custom_id == "buy_credits":
-        await interaction.response.send_message("💰 Enter how many credits you want to buy (min 5):", ephemeral=True)
-
-        def check(m):
-            return m.author.id == user.id and m.channel == interaction.channel
-
-        try:
-            msg = await bot.wait_for("message", timeout=30.0, check=check)
-            quantity = int(msg.content)
+    def __init__(self):
+        super().__init__(custom_id=modal_id("buy_credits_modal"))
 
+    async def on_submit(self, interaction: discord.Interaction):
+        with track_interaction(interaction, "buy_credits_submit"):
             try:
-                await msg.delete()
-            except discord.NotFound:
-                print("Message already deleted or not found.")
+                quantity = int(self.quantity.value)
+            except ValueError:
+                await interaction.response.send_message("❌ Invalid input.", ephemeral=True)
+                return
 
             if quantity < MIN_CREDITS:
-                await interaction.followup.send("❌ Minimum is 5 credits.", ephemeral=True)
+                await interaction.response.send_message("❌ Minimum is 5 credits.", ephemeral=True)
                 return
 
-            session_url = create_credit_purchase_session(user.id, quantity)
+            await interaction.response.defer(ephemeral=True)
+            try:
+                session_url = await get_credit_checkout_url(interaction.user.id, quantity)
+            except stripe.error.StripeError as e:
+                log.error(f"❌ Could not create credit checkout: {e}")
+                await interaction.followup.send("⚠️ Could not start the checkout. Please try again.", ephemeral=True)
+                return
             await interaction.followup.send(
                 "Click below to purchase your credits:",
                 view=discord.ui.View().add_item(discord.ui.Button(label="💳 Buy Now", url=session_url)),
                 ephemeral=True
             )
-        except Exception:
-            await interaction.followup.send("❌ Invalid input or timeout.", ephemeral=True)
-        return
 
-    if custom_id in ["video_text", "video_image"]:
-        if not has_access:
-            await interaction.response.send_message("🔒 You need access!", view=PaymentMenu(), ephemeral=True)
-            return
+class PromptModal(discord.ui.Modal, title="📝 Video Prompt"):
+    prompt = discord.ui.TextInput(label="Describe your video", style=discord.TextStyle.paragraph, max_length=512)
 
-        required_credits = 2 if custom_id == "video_image" else 1
-        credits = get_credits(user.id)
-        if credits < required_credits:
-            await interaction.followup.send("⚠️ You don’t have enough credits. Please buy more.", ephemeral=True)
-            return
+    def __init__(self, ratio):
+        super().__init__(timeout=300, custom_id=modal_id("prompt_modal"))
+        self.ratio = ratio
 
-        print(f"User selecting aspect ratio for {custom_id}")
-
-        menu = VideoRatioMenu(interaction, custom_id)
-        await interaction.followup.send("📐 Choose a video aspect ratio:", view=menu, ephemeral=True)
-        return
+    async def on_submit(self, interaction: discord.Interaction):
+        with track_interaction(interaction, "prompt_submit"):
+            await interaction.response.defer(ephemeral=True)
+            await start_generation(interaction, self.prompt.value, self.ratio)
 
+# --- History Pagination ---
+def history_embed(page, number):
+    if page["videos"]:
+        history_text = "\n".join(f"📹 {row['generated_at'][:16].replace('T', ' ')} — {row['video_url']}" for row in page["videos"])
+    else:
+        history_text = "📜 No history found!"
+    embed = discord.Embed(title="📜 Your Video History", description=history_text, color=discord.Color.blue())
+    embed.set_footer(text=f"Page {number}")
+    return embed
+
+class HistoryView(discord.ui.View):
+    def __init__(self, user_id, page, number):
+        super().__init__(timeout=300)
+        self.user_id = user_id
+        self.page = page
+        self.number = number
+        self.newer.disabled = not page["has_newer"] or not page["videos"]
+        self.older.disabled = not page["has_older"] or not page["videos"]
+
+    async def show(self, interaction, page, number):
+        await interaction.response.edit_message(embed=history_embed(page, number), view=HistoryView(self.user_id, page, number))
+
+    @discord.ui.button(label="◀️ Newer", style=discord.ButtonStyle.gray)
+    async def newer(self, interaction: discord.Interaction, button: discord.ui.Button):
+        page = await get_history_page(self.user_id, newer_than=self.page["videos"][0]["generated_at"])
+        await self.show(interaction, page, max(self.number - 1, 1))
+
+    @discord.ui.button(label="Older ▶️", style=discord.ButtonStyle.gray)
+    async def older(self, interaction: discord.Interaction, button: discord.ui.Button):
+        page = await get_history_page(self.user_id, older_than=self.page["videos"][-1]["generated_at"])
+        await self.show(interaction, page, self.number + 1)
+
+# custom_ids that get their own label in kolde_interaction_seconds
+INTERACTION_ACTIONS = ["login", "get_access", "check_credits", "buy_credits", "video_text", "video_image", "history", "refresh"]
+
+def interaction_action(custom_id):
     if custom_id.startswith("ratio_"):
-        parts = custom_id.split("_")
-        if len(parts) < 3:
-            await interaction.followup.send("⚠️ Invalid selection!", ephemeral=True)
+        return "ratio"
+    return custom_id if custom_id in INTERACTION_ACTIONS else "other"
+
+@contextlib.contextmanager
+def track_interaction(interaction, action):
+    """Tags log records with the interaction ID and times the handling in kolde_interaction_seconds.
+
+    Used by every entry point: component clicks, modal submits and slash commands.
+    """
+    interaction_id_var.set(str(interaction.id))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        INTERACTION_SECONDS.labels(action).observe(time.perf_counter() - started)
+
+# --- Component Dispatch ---
+# MenuButton clicks are routed here by custom_id. Keys ending in "_" match by
+# prefix, so "ratio_" handles "ratio_16_9_video_text".
+COMPONENT_HANDLERS = {}
+
+def component(custom_id, defer=False, requires_access=False):
+    def register(handler):
+        COMPONENT_HANDLERS[custom_id] = (handler, defer, requires_access)
+        return handler
+    return register
+
+async def dispatch_component(interaction: discord.Interaction):
+    custom_id = interaction.data.get("custom_id", "")
+    with track_interaction(interaction, interaction_action(custom_id)):
+        entry = COMPONENT_HANDLERS.get(custom_id) or COMPONENT_HANDLERS.get(custom_id.split("_", 1)[0] + "_")
+        if entry is None:
+            log.warning(f"No handler for component {custom_id}")
             return
 
-        ratio = f"{parts[1]}_{parts[2]}"
-        video_type = "video_text" if "video_text" in custom_id else "video_image"
+        handler, defer, requires_access = entry
+        log.debug(f"Interaction received: {custom_id}")
+        if await starting_up(interaction):
+            return
 
-        if not interaction.response.is_done():
+        if defer:
             try:
                 await interaction.response.defer(ephemeral=True)
             except discord.errors.NotFound:
-                print("Interaction expired before deferring.")
+                log.info("Interaction expired before deferring.")
                 return
 
-        prompt_request = "📝 Please enter your text prompt:" if video_type == "video_text" else "🖼️ Upload an image and enter a text prompt:"
-        await interaction.followup.send(prompt_request, ephemeral=True)
-
-        def check(msg):
-            return msg.author == user and msg.channel == interaction.channel
+        if requires_access and not await check_access(interaction.user):
+            send = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
+            await send("🔒 You need access!", view=PaymentMenu.render(), ephemeral=True)
+            return
 
-        try:
-            msg = await bot.wait_for("message", check=check, timeout=60)
-            prompt = msg.content
-            image_url = msg.attachments[0].url if video_type == "video_image" and msg.attachments else None
+        await handler(interaction)
 
-            if video_type == "video_image" and not image_url:
-                await interaction.followup.send("⚠️ Please attach an image along with your text!", ephemeral=True)
-                return
+@component("get_access", defer=True)
+async def get_access_clicked(interaction):
+    try:
+        session_url = await get_access_checkout_url(interaction.user.id)
+    except stripe.error.StripeError as e:
+        log.error(f"❌ Could not create access checkout: {e}")
+        await interaction.followup.send("⚠️ Could not start the checkout. Please try again.", ephemeral=True)
+        return
+    await interaction.followup.send(
+        "🔒 You need access! Click below to purchase:",
+        view=discord.ui.View().add_item(
+            discord.ui.Button(label="💰 Buy Access", style=discord.ButtonStyle.link, url=session_url)
+        ),
+        ephemeral=True
+    )
 
-            try:
-                await msg.delete()
-            except discord.NotFound:
-                print("Message already deleted or not found.")
+def function_menu(has_access):
+    content = "✅ You now have access to all functions!" if has_access else "🔒 You need access! Choose a payment method below:"
+    return content, FullFunctionMenu.render() if has_access else PaymentMenu.render()
+
+@component("login")
+async def login_clicked(interaction):
+    content, view = function_menu(await check_access(interaction.user))
+    await interaction.response.send_message(content, view=view, ephemeral=True)
+
+@component("refresh")
+async def refresh_clicked(interaction):
+    content, view = function_menu(await check_access(interaction.user))
+    await interaction.response.edit_message(content=content, view=view)
+
+@component("check_credits", defer=True)
+async def check_credits_clicked(interaction):
+    credits = await get_credits(interaction.user.id)
+    await interaction.followup.send(f"💼 You have **{credits}** credits.", ephemeral=True)
+
+@component("buy_credits")
+async def buy_credits_clicked(interaction):
+    await interaction.response.send_modal(BuyCreditsModal())
+
+async def can_generate(interaction, required_credits):
+    if runway_breaker.state == "open":
+        await interaction.followup.send("🚧 The video provider is currently unavailable. Please try again in a few minutes.", ephemeral=True)
+        return False
+
+    credits = await get_credits(interaction.user.id)
+    if credits < required_credits:
+        await interaction.followup.send("⚠️ You don’t have enough credits. Please buy more.", ephemeral=True)
+        return False
+    return True
+
+@component("video_text", defer=True, requires_access=True)
+async def video_text_clicked(interaction):
+    if not await can_generate(interaction, 1):
+        return
 
-        except asyncio.TimeoutError:
-            await interaction.followup.send("⏳ Timeout! Please try again.", ephemeral=True)
-            return
+    log.debug("User selecting aspect ratio for video_text")
+    await interaction.followup.send("📐 Choose a video aspect ratio:", view=VideoRatioMenu.render(), ephemeral=True)
 
-        required_credits = 2 if video_type == "video_image" else 1
-        deduct_credits(user.id, required_credits)
+@component("video_image", defer=True, requires_access=True)
+async def video_image_clicked(interaction):
+    if not await can_generate(interaction, 2):
+        return
 
-        print(f"Generating video with prompt: {prompt}, ratio: {ratio}, image_url: {image_url}")
-        await interaction.followup.send("⏳ Generating your video...", ephemeral=True)
-        await asyncio.sleep(5)
+    # Modals can't take file uploads, so images come in through the slash command's attachment option
+    await interaction.followup.send("🖼️ Use `/video_image` to attach your image, write a prompt and pick a ratio.", ephemeral=True)
 
-        job_id = await generate_video(prompt, ratio, image_url)
-        print(f"🔁 generate_video() returned job_id: {job_id}")
+@component("ratio_")
+async def ratio_clicked(interaction):
+    parts = interaction.data["custom_id"].split("_")
+    if len(parts) < 3:
+        await interaction.response.send_message("⚠️ Invalid selection!", ephemeral=True)
+        return
 
-        if not job_id:
-            await interaction.followup.send("❌ Failed to start video generation. Please try again.", ephemeral=True)
-            return
+    await interaction.response.send_modal(PromptModal(f"{parts[1]}_{parts[2]}"))
 
-        # 🛠️ Wait a few seconds before polling to ensure job is registered
-        await asyncio.sleep(10)
+@component("history", defer=True, requires_access=True)
+async def history_clicked(interaction):
+    page = await get_history_page(interaction.user.id)
+    await interaction.followup.send(embed=history_embed(page, 1), view=HistoryView(interaction.user.id, page, 1), ephemeral=True)
 
-        await interaction.followup.send("⏳ Video generation started. Waiting for completion...", ephemeral=True)
+async def start_generation(interaction, prompt, ratio, image_url=None):
+    """Charge for and start a generation from a deferred modal or slash command interaction."""
+    if runway_breaker.state == "open":
+        await interaction.followup.send("🚧 The video provider is currently unavailable. Please try again in a few minutes.", ephemeral=True)
+        return
 
-        video_url = await poll_video_status(job_id, timeout=600)
+    # A repeat of a request the user still has in flight would join their own
+    # job and be charged for a video they only receive once.
+    pending = (request_key(prompt, ratio, image_url), interaction.user.id)
+    if pending in pending_requests:
+        await interaction.followup.send("🔁 This video is already being generated for you. It will arrive in your DMs.", ephemeral=True)
+        return
+    pending_requests.add(pending)
+    try:
+        required_credits = 2 if image_url else 1
+        request_id = new_request_id()
+        try:
+            await run_blocking(create_job_record, request_id, interaction.user.id, prompt, ratio, image_url, required_credits)
+        except Exception as e:
+            log.error(f"❌ Could not record request {request_id}: {e}")
+            await interaction.followup.send("⚠️ Could not start your request. Please try again.", ephemeral=True)
+            return
 
-        if video_url:
+        if not await deduct_credits(interaction.user.id, required_credits, reference=request_id):
             try:
-                await user.send(f"🎥 Your video is ready! Click here: {video_url}")
-                print(f"📬 Sent DM to {user.name} ({user.id})")
-                await interaction.followup.send("✅ Video sent to your DMs!", ephemeral=True)
-            except discord.Forbidden:
-                print(f"⚠️ Cannot DM {user.name} — DMs disabled.")
-                await interaction.followup.send(f"🎥 Your video is ready! Click here: {video_url}", ephemeral=True)
+                await run_blocking(delete_job_record, request_id, interaction.user.id)
             except Exception as e:
-                print(f"❌ Failed to send DM: {e}")
-                await interaction.followup.send(f"🎥 Your video is ready! Click here: {video_url}", ephemeral=True)
+                log.warning(f"⚠️ Could not delete unpaid request {request_id}: {e}")  # release_queued_jobs clears it
+            await interaction.followup.send("⚠️ You don’t have enough credits. Please buy more.", ephemeral=True)
+            return
 
-    # Save to history
-            supabase.table("video_history").insert({
-                "user_id": str(user.id),
-                "prompt": prompt,
-                "video_url": video_url,
-                "generated_at": datetime.utcnow().isoformat() 
-            }).execute()
+        log.info(f"Generating video with prompt: {prompt}, ratio: {ratio}, image_url: {image_url}")
+        await interaction.followup.send("⏳ Generating your video...", ephemeral=True)
+        await asyncio.sleep(5)
 
-        else:
-            print("❌ Video generation failed or timed out.")
-            await interaction.followup.send("❌ Failed to generate video. Please try again later.", ephemeral=True)
-    
-# This block should NOT be indented inside the video logic
-    if custom_id == "history":
-        if not has_access:
-            await interaction.response.send_message("🔒 You need access!", view=PaymentMenu(), ephemeral=True)
-            return
+        await run_generation(interaction, request_id, prompt, ratio, image_url, required_credits)
+    finally:
+        pending_requests.discard(pending)
+
+MENU_SEARCH_LIMIT = 50
 
-        history = fetch_video_history(user.id)
-        history_text = "\n".join([f"📹 {video}" for video in history]) if history else "📜 No history found!"
-        embed = discord.Embed(title="📜 Your Video History", description=history_text, color=discord.Color.blue())
-        await interaction.followup.send(embed=embed, ephemeral=True)
-            
 async def setup_menu(channel):
     embed = discord.Embed(
         title="🎬 Kolde AI",
@@ -453,61 +2086,488 @@ async def setup_menu(channel):
         ),
         color=discord.Color.dark_blue()
     )
-    await channel.send(embed=embed, view=MainMenu())
+
+    # Reuse the menu we posted last time instead of adding another one on every start
+    async for message in channel.history(limit=MENU_SEARCH_LIMIT):
+        if message.author == bot.user and message.embeds and message.embeds[0].title == embed.title:
+            await message.edit(embed=embed, view=MainMenu.render())
+            return message
+
+    return await channel.send(embed=embed, view=MainMenu.render())
     
-async def keep_alive():
-    while True:
-        print("✅ Bot is running... (Keep-alive)")
-        await asyncio.sleep(600)  # Keep active every 10 minutes
+# --- Metrics endpoint ---
+Gauge("kolde_generation_running", "Generations holding a scheduler slot").set_function(lambda: generation_scheduler.running)
+Gauge("kolde_generation_queued", "Generations waiting for a scheduler slot").set_function(generation_scheduler.waiting)
+Gauge("kolde_jobs_polling", "Jobs registered with the poller").set_function(lambda: len(job_poller.jobs))
+Gauge("kolde_deliveries_active", "Jobs being polled or delivered").set_function(lambda: len(active_deliveries))
+Gauge("kolde_delivery_queue", "Finished videos waiting for a delivery worker").set_function(delivery_pool.pending)
+Gauge("kolde_runway_circuit_open", "1 while the Runway circuit breaker rejects calls").set_function(lambda: runway_breaker.state == "open")
+Gauge("kolde_balance_cache_hit_ratio", "Balance cache hit ratio").set_function(lambda: balance_cache.stats()["hit_rate"])
+Gauge("kolde_access_index_known", "Users with a cached access decision").set_function(lambda: len(access_index.known))
+
+class CacheCounters:
+    """Exports the caches' running totals as counters (kolde_*_total), read when scraped."""
+
+    def collect(self):
+        yield CounterMetricFamily("kolde_balance_cache_hits", "Balance cache hits", value=balance_cache.hits)
+        yield CounterMetricFamily("kolde_balance_cache_misses", "Balance cache misses", value=balance_cache.misses)
+        yield CounterMetricFamily("kolde_result_cache_hits", "Requests answered from the result cache", value=result_cache.hits)
+        yield CounterMetricFamily("kolde_result_cache_coalesced", "Requests that joined an identical in-flight job", value=result_cache.coalesced)
+
+REGISTRY.register(CacheCounters())
+
+# --- Bot HTTP server ---
+# Serves /ready and /metrics, and with SERVE_WEBHOOK=1 also /stripe-webhook, so one
+# process can replace the gunicorn webhook service (see start.sh). The
+# webhook then shares the bot's Supabase client and fulfillment worker.
+
+http_runner = None
+
+async def health_handler(request):
+    return web.Response(text="ok")
+
+async def ready_handler(request):
+    """200 once startup has finished and every health probe passed, 503 before that."""
+    if startup.ready and not startup.healthy():
+        startup.probes = await run_health_probes()  # Supabase may have been down only at startup
+    probes = {table: error or "ok" for table, error in startup.probes.items()}
+    return web.json_response({"ready": startup.ready, "probes": probes}, status=200 if startup.healthy() else 503)
+
+async def metrics_handler(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def stripe_webhook_handler(request):
+    from webhook import record_event
+
+    payload = await request.text()
+    sig_header = request.headers.get("Stripe-Signature")
+    try:
+        await run_blocking(record_event, payload, sig_header, get_supabase())
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return web.Response(text="Webhook signature verification failed", status=400)
+    except Exception as e:
+        # Not stored, so let Stripe retry the delivery
+        log.error(f"❌ Could not store Stripe event: {e}")
+        return web.Response(text="Could not store event", status=500)
+
+    fulfillment_worker.wakeup()
+    return web.json_response({"success": True})
+
+async def start_http_server():
+    global http_runner
+    if http_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/", health_handler)
+    app.router.add_get("/ready", ready_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if SERVE_WEBHOOK:
+        app.router.add_post("/stripe-webhook", stripe_webhook_handler)
+    http_runner = web.AppRunner(app, access_log=None)
+    await http_runner.setup()
+    try:
+        await web.TCPSite(http_runner, "0.0.0.0", HTTP_PORT).start()
+    except OSError as e:
+        log.warning(f"⚠️ Could not start HTTP server on :{HTTP_PORT}: {e}")
+        return
+    log.info(f"📈 HTTP server on :{HTTP_PORT} (/ready, /metrics{', /stripe-webhook' if SERVE_WEBHOOK else ''})")
+
+async def stop_http_server():
+    global http_runner
+    if http_runner is not None:
+        await http_runner.cleanup()
+        http_runner = None
+
+# --- Event loop monitor ---
+# A heartbeat task measures how late the loop runs it (scheduling lag). A
+# watchdog thread checks that the heartbeat keeps beating. If one callback
+# holds the loop for longer than LOOP_BLOCK_THRESHOLD, the watchdog grabs the
+# loop thread's stack and logs where it is stuck. That is usually a
+# Supabase/Stripe call that should go through run_blocking.
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.5"))
+STATS_LOG_INTERVAL = 600
+THIS_FILE = os.path.abspath(__file__)
+
+EVENT_LOOP_LAG = Histogram("kolde_event_loop_lag_seconds", "How late the event loop ran the monitor's heartbeat",
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+EVENT_LOOP_BLOCKS = Counter("kolde_event_loop_blocks_total", "Callbacks that held the event loop past LOOP_BLOCK_THRESHOLD", ["where"])
+
+def blocking_location(frame):
+    """The innermost frame in this file, i.e. our call that is blocking (the stack has the library frames)."""
+    innermost = frame
+    while frame is not None:
+        if os.path.abspath(frame.f_code.co_filename) == THIS_FILE:
+            return f"{frame.f_code.co_name} (bot.py:{frame.f_lineno})"
+        frame = frame.f_back
+    return f"{innermost.f_code.co_name} ({os.path.basename(innermost.f_code.co_filename)}:{innermost.f_lineno})"
+
+class LoopMonitor:
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = None  # time.monotonic() of the last heartbeat
+        self.blocks = {}  # where -> times caught blocking
+        self.max_lag = 0.0  # since the last stats line
+        self.last_block = None
+        self._reported_beat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        next_stats = loop.time() + STATS_LOG_INTERVAL
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            lag = max(now - scheduled, 0)
+            self.last_beat = time.monotonic()
+            EVENT_LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                log.warning(f"🐢 Event loop was blocked for {lag:.2f}s (in {self.last_block or 'an unknown callback'})")
+                self.last_block = None
+            if now >= next_stats:
+                self.log_stats()
+                next_stats = now + STATS_LOG_INTERVAL
+
+    def _watch(self):
+        # Runs in its own thread, so it still gets to run while the loop is stuck
+        while not self._stopping.wait(self.interval):
+            beat = self.last_beat
+            if time.monotonic() - beat < self.threshold or beat == self._reported_beat:
+                continue
+            self._reported_beat = beat  # one report per stall
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            where = blocking_location(frame)
+            self.last_block = where
+            self.blocks[where] = self.blocks.get(where, 0) + 1
+            EVENT_LOOP_BLOCKS.labels(where).inc()
+            stack = "".join(traceback.format_stack(frame))
+            log.warning(f"🐢 Event loop blocked for over {self.threshold}s in {where}:\n{stack}")
+
+    def log_stats(self):
+        stats = balance_cache.stats()
+        log.info(f"✅ Bot is running | max loop lag {self.max_lag * 1000:.0f}ms, {sum(self.blocks.values())} blocking calls caught so far"
+                 f" | balance cache: {stats['size']} entries, {stats['hit_rate']:.0%} hit rate")
+        self.max_lag = 0.0
+
+loop_monitor = LoopMonitor()
+
+# --- Startup ---
+# Importing bot.py only defines things: create_app() configures logging and
+# Stripe, the Supabase client is created on first use, and setup_hook brings
+# up the HTTP server before the gateway connects. The work that needs
+# Supabase runs once, in the background, after the first READY. on_ready
+# fires again after every reconnect that can't resume the session, and a
+# slow probe shouldn't hold up the gateway either way.
+STARTING_UP_MESSAGE = "⏳ The bot is starting up, please try again in a few seconds."
+
+class Startup:
+    def __init__(self):
+        self.ready = False
+        self.probes = {}
+        self._task = None
+
+    def begin(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def healthy(self):
+        return self.ready and not any(self.probes.values())
+
+    async def run(self):
+        started = time.perf_counter()
+        get_http_session()
+        self.probes = await run_health_probes()
+        job_poller.start()
+        delivery_pool.start()
+        await release_queued_jobs()
+        await resume_jobs()
+        fulfillment_worker.start()
+        self.ready = True
+        log.info(f"🚀 Ready {time.perf_counter() - started:.2f}s after connecting")
+
+        channel = bot.get_channel(CHANNEL_ID)
+        if channel:
+            try:
+                await setup_menu(channel)
+            except discord.HTTPException as e:
+                log.warning(f"⚠️ Could not post the menu: {e}")
+
+startup = Startup()
+
+async def starting_up(interaction: discord.Interaction):
+    """Answers the interaction and returns True if startup hasn't finished yet."""
+    if startup.ready:
+        return False
+    await interaction.response.send_message(STARTING_UP_MESSAGE, ephemeral=True)
+    return True
 
 @bot.event
 async def on_ready():
-    print(f"✅ Logged in as {bot.user}")
-    init_db()
-    bot.loop.create_task(keep_alive())  # Keep bot active
-    channel = bot.get_channel(CHANNEL_ID)
-    if channel:
-        await setup_menu(channel)
+    log.info(f"✅ Logged in as {bot.user}")
+    startup.begin()
+
+@bot.event
+async def on_member_update(before, after):
+    if after.guild.id == GUILD_ID:
+        access_index.observe(after)
+
+@bot.event
+async def on_member_remove(member):
+    if member.guild.id == GUILD_ID:
+        access_index.forget(member.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    if role.id == ACCESS_ROLE_ID:
+        access_index.clear()
 
 @bot.event
 async def on_disconnect():
-    print("🔴 Bot disconnected! Reconnecting...")
+    log.info("🔴 Bot disconnected! Reconnecting...")
     await asyncio.sleep(5)  # Wait 5 seconds before trying to reconnect
 
 @bot.event
 async def on_resumed():
-    print("🔄 Reconnected successfully!")
-
-@bot.command(name="add_credits")
+    log.info("🔄 Reconnected successfully!")
+
+# --- Credit reports ---
+# user_credits is read in keyset pages ordered by (sort column, user_id), so
+# neither the embed pages nor the CSV export ever hold the whole table.
+CREDIT_REPORT_PAGE_SIZE = 20
+CREDIT_EXPORT_BATCH_SIZE = 1000
+CREDIT_REPORT_SORTS = {"credits": "credits", "user_id": "user_id", "last_active": "updated_at"}
+
+def fetch_credit_report_page(sort="credits", descending=False, max_credits=None, inactive_days=None, after=None, limit=CREDIT_REPORT_PAGE_SIZE):
+    """Returns up to limit rows. after is report_cursor() of the last row of the previous page."""
+    column = CREDIT_REPORT_SORTS[sort]
+    query = get_supabase().table("user_credits").select("user_id, credits, updated_at")
+    if max_credits is not None:
+        query = query.lte("credits", max_credits)
+    if inactive_days is not None:
+        query = query.lt("updated_at", (datetime.utcnow() - timedelta(days=inactive_days)).isoformat())
+
+    op = "lt" if descending else "gt"
+    if after is not None:
+        value, user_id = after
+        if column == "user_id":
+            query = query.filter("user_id", op, user_id)
+        else:
+            # quoted because timestamps contain PostgREST's reserved "." and ":"
+            query = query.or_(f'{column}.{op}."{value}",and({column}.eq."{value}",user_id.{op}.{user_id})')
+
+    query = query.order(column, desc=descending)
+    if column != "user_id":
+        query = query.order("user_id", desc=descending)
+    return query.limit(limit).execute().data
+
+def report_cursor(row, sort):
+    return row[CREDIT_REPORT_SORTS[sort]], row["user_id"]
+
+async def export_credit_report(path, report):
+    """Streams the report into a CSV file one batch at a time. Returns the number of rows written."""
+    count = 0
+    after = None
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["user_id", "credits", "last_active"])
+        while True:
+            rows = await run_blocking(fetch_credit_report_page, **report, after=after, limit=CREDIT_EXPORT_BATCH_SIZE)
+            writer.writerows([row["user_id"], row["credits"], row["updated_at"]] for row in rows)
+            count += len(rows)
+            if len(rows) < CREDIT_EXPORT_BATCH_SIZE:
+                return count
+            after = report_cursor(rows[-1], report["sort"])
+
+def describe_report(report):
+    parts = [f"sorted by {report['sort']} {'↓' if report['descending'] else '↑'}"]
+    if report["max_credits"] is not None:
+        parts.append(f"≤ {report['max_credits']} credits")
+    if report["inactive_days"] is not None:
+        parts.append(f"inactive {report['inactive_days']}+ days")
+    return ", ".join(parts)
+
+def credit_report_embed(rows, report, number):
+    lines = [f"<@{row['user_id']}> — **{row['credits']}** credits · active {(row['updated_at'] or 'never')[:10]}" for row in rows]
+    embed = discord.Embed(title="🧾 User credits", description="\n".join(lines), color=discord.Color.blue())
+    embed.set_footer(text=f"Page {number} · {describe_report(report)}")
+    return embed
+
+class CreditReportView(discord.ui.View):
+    def __init__(self, admin_id, report, rows, cursors):
+        super().__init__(timeout=600)
+        self.admin_id = admin_id
+        self.report = report
+        self.rows = rows  # one extra row tells us there is a next page
+        self.cursors = cursors  # start cursor of every page up to this one
+        self.previous.disabled = len(cursors) <= 1
+        self.next.disabled = len(rows) <= CREDIT_REPORT_PAGE_SIZE
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.admin_id
+
+    async def show(self, interaction, cursors):
+        rows = await run_blocking(fetch_credit_report_page, **self.report, after=cursors[-1], limit=CREDIT_REPORT_PAGE_SIZE + 1)
+        await interaction.response.edit_message(embed=credit_report_embed(rows[:CREDIT_REPORT_PAGE_SIZE], self.report, len(cursors)),
+                                                view=CreditReportView(self.admin_id, self.report, rows, cursors))
+
+    @discord.ui.button(label="◀️ Previous", style=discord.ButtonStyle.gray)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.cursors[:-1])
+
+    @discord.ui.button(label="Next ▶️", style=discord.ButtonStyle.gray)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.cursors + [report_cursor(self.rows[CREDIT_REPORT_PAGE_SIZE - 1], self.report["sort"])])
+
+# --- Bulk refunds ---
+def refund_reference(job):
+    return f"refund:{job['job_id']}:{job['user_id']}"
+
+def fetch_failed_jobs(since, offset, limit=BULK_CREDIT_BATCH_SIZE):
+    # Refunding doesn't change a job's status, so offsets stay stable while we page
+    return (get_supabase().table("generation_jobs").select("job_id, user_id, credits")
+            .eq("status", "failed").gte("updated_at", since).gt("credits", 0)
+            .order("updated_at").order("job_id").order("user_id")
+            .range(offset, offset + limit - 1).execute().data)
+
+def unrefunded_jobs(jobs):
+    """Drops jobs whose refund is already in the ledger (matched by reference)."""
+    refunded = get_supabase().table("credit_transactions").select("reference").in_("reference", [refund_reference(job) for job in jobs]).execute().data
+    done = {row["reference"] for row in refunded}
+    return [job for job in jobs if refund_reference(job) not in done]
+
+@bot.hybrid_command(name="add_credits")
 @commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
 async def add_credits_command(ctx, member: discord.Member, amount: int):
-    add_credits(member.id, amount)
+    await add_credits(member.id, amount, reason="admin_grant", reference=str(ctx.author.id))
     await ctx.send(f"✅ Added {amount} credits to {member.mention}.")
 
-@bot.command(name="remove_credits")
+@bot.hybrid_command(name="remove_credits")
 @commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
 async def remove_credits_command(ctx, member: discord.Member):
-    supabase.table("user_credits").delete().eq("user_id", member.id).execute()
+    await clear_credits(member.id)
     await ctx.send(f"🗑️ Removed all credits for {member.mention}.")
 
-@bot.command(name="check_credits")
+MEMBER_ID_PATTERN = re.compile(r"\d{15,20}")  # raw IDs and <@id> mentions
+
+@bot.hybrid_command(name="bulk_grant")
+@commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(amount="Credits to add to each member", members="Member mentions or IDs, separated by spaces")
+async def bulk_grant_command(ctx, amount: int, *, members: str):
+    user_ids = list(dict.fromkeys(MEMBER_ID_PATTERN.findall(members)))
+    if amount <= 0 or not user_ids:
+        await ctx.send("❌ Usage: bulk_grant <amount > 0> <@member> <@member> ...")
+        return
+
+    await ctx.defer()
+    reference = str(ctx.author.id)
+    balances = await bulk_add_credits([{"user_id": user_id, "delta": amount, "reference": reference} for user_id in user_ids], "admin_grant")
+    await ctx.send(f"✅ Added {amount} credits to {len(balances)} users.")
+
+@bot.hybrid_command(name="refund_failed")
+@commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(hours="Refund jobs that failed within this many hours")
+async def refund_failed_command(ctx, hours: int = 24):
+    await ctx.defer()
+    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    offset = 0
+    refunded, credits, users = 0, 0, set()
+    while True:
+        page = await run_blocking(fetch_failed_jobs, since, offset)
+        jobs = await run_blocking(unrefunded_jobs, page) if page else []
+        if jobs:
+            grants = [{"user_id": job["user_id"], "delta": job["credits"], "reference": refund_reference(job)} for job in jobs]
+            users.update(await bulk_add_credits(grants, "refund"))
+            refunded += len(jobs)
+            credits += sum(job["credits"] for job in jobs)
+        if len(page) < BULK_CREDIT_BATCH_SIZE:
+            break
+        offset += len(page)
+
+    if not refunded:
+        await ctx.send(f"✅ No unrefunded failed jobs in the last {hours}h.")
+        return
+    await ctx.send(f"↩️ Refunded {credits} credits for {refunded} failed jobs to {len(users)} users.")
+
+@bot.hybrid_command(name="check_credits")
 async def check_credits_command(ctx, member: discord.Member = None):
     user = member or ctx.author
-    credits = get_credits(user.id)
+    credits = await get_credits(user.id)
     await ctx.send(f"💰 {user.mention} has **{credits}** credits.")
 
-@bot.command(name="list_credits")
+@bot.hybrid_command(name="list_credits")
 @commands.has_permissions(administrator=True)
-async def list_credits(ctx):
-    result = supabase.table("user_credits").select("*").execute()
-    if result.data:
-        lines = [f"{row['user_id']}: {row['credits']} credits" for row in result.data]
-        await ctx.send("🧾 **All users & credits:**\n" + "\n".join(lines))
-    else:
-        await ctx.send("❌ No credit records found.")
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(sort="Column to sort by", order="Sort direction", max_credits="Only users with at most this many credits",
+                       inactive_days="Only users without credit activity for this many days", export="Send a CSV file instead of pages")
+async def list_credits(ctx, sort: Literal["credits", "user_id", "last_active"] = "credits", order: Literal["asc", "desc"] = "asc",
+                       max_credits: Optional[int] = None, inactive_days: Optional[int] = None, export: bool = False):
+    await ctx.defer(ephemeral=True)
+    report = {"sort": sort, "descending": order == "desc", "max_credits": max_credits, "inactive_days": inactive_days}
+
+    if export:
+        fd, path = tempfile.mkstemp(suffix=".csv", prefix="kolde-credits-")
+        os.close(fd)
+        try:
+            count = await export_credit_report(path, report)
+            if not count:
+                await ctx.send("❌ No credit records found.", ephemeral=True)
+            elif os.path.getsize(path) > DISCORD_UPLOAD_LIMIT:
+                await ctx.send("❌ The export is too large to upload. Narrow it down with max_credits or inactive_days.", ephemeral=True)
+            else:
+                await ctx.send(f"🧾 {count} users ({describe_report(report)})", file=discord.File(path, filename="credits.csv"), ephemeral=True)
+        finally:
+            os.remove(path)
+        return
 
-@bot.command(name="post_tos")
+    rows = await run_blocking(fetch_credit_report_page, **report, limit=CREDIT_REPORT_PAGE_SIZE + 1)
+    if not rows:
+        await ctx.send("❌ No credit records found.", ephemeral=True)
+        return
+    await ctx.send(embed=credit_report_embed(rows[:CREDIT_REPORT_PAGE_SIZE], report, 1),
+                   view=CreditReportView(ctx.author.id, report, rows, [None]), ephemeral=True)
+
+@bot.hybrid_command(name="post_tos")
 @commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
 async def post_tos(ctx):
     embed = discord.Embed(
         title="📜 Termeni și Condiții – Kolde AI",
@@ -536,4 +2596,72 @@ async def post_tos(ctx):
 
     await ctx.send(embed=embed)
 
-bot.run(TOKEN)
+# --- Slash Commands ---
+RATIO_CHOICES = [
+    app_commands.Choice(name="16:9", value="16_9"),
+    app_commands.Choice(name="9:16", value="9_16"),
+    app_commands.Choice(name="1:1", value="1_1"),
+]
+
+@bot.tree.command(name="video_text", description="Generate a video from a text prompt (1 credit)")
+@app_commands.describe(prompt="Describe your video", ratio="Video aspect ratio")
+@app_commands.choices(ratio=RATIO_CHOICES)
+async def video_text_command(interaction: discord.Interaction, prompt: app_commands.Range[str, 1, 512], ratio: app_commands.Choice[str]):
+    with track_interaction(interaction, "video_text_command"):
+        if await starting_up(interaction):
+            return
+        await interaction.response.defer(ephemeral=True)
+        if not await check_access(interaction.user):
+            await interaction.followup.send("🔒 You need access!", view=PaymentMenu.render(), ephemeral=True)
+            return
+
+        await start_generation(interaction, prompt, ratio.value)
+
+@bot.tree.command(name="video_image", description="Generate a video from an image and a text prompt (2 credits)")
+@app_commands.describe(image="Image to animate", prompt="Describe your video", ratio="Video aspect ratio")
+@app_commands.choices(ratio=RATIO_CHOICES)
+async def video_image_command(interaction: discord.Interaction, image: discord.Attachment, prompt: app_commands.Range[str, 1, 512], ratio: app_commands.Choice[str]):
+    with track_interaction(interaction, "video_image_command"):
+        if await starting_up(interaction):
+            return
+        await interaction.response.defer(ephemeral=True)
+        if not await check_access(interaction.user):
+            await interaction.followup.send("🔒 You need access!", view=PaymentMenu.render(), ephemeral=True)
+            return
+
+        if await get_credits(interaction.user.id) < 2:
+            await interaction.followup.send("⚠️ You don’t have enough credits. Please buy more.", ephemeral=True)
+            return
+
+        try:
+            image_url = await prepare_input_image(image, ratio.value)
+        except ImageRejected as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+            return
+        except Exception as e:
+            log.error(f"❌ Could not prepare input image {image.filename}: {e}")
+            await interaction.followup.send("⚠️ Could not process your image. Please try again.", ephemeral=True)
+            return
+
+        await start_generation(interaction, prompt, ratio.value, image_url)
+
+def create_app():
+    """Configures the process for running the bot and returns it.
+
+    Kept out of import time so tools such as loadtest.py can import bot.py
+    without side effects and point it at other services first.
+    """
+    setup_logging()
+    if not TOKEN or not RUNWAY_API_KEY:
+        log.critical("❌ ERROR: Missing bot token or API key!")
+        raise SystemExit(1)
+    if not VIDEO_BUCKET:
+        log.warning("⚠️ VIDEO_BUCKET is not set: videos are not re-hosted and history links will expire with the provider's URLs.")
+    stripe.api_key = STRIPE_SECRET_KEY
+    return bot
+
+def main():
+    create_app().run(TOKEN, log_handler=None)  # discord.py logs go through our queue handler
+
+if __name__ == "__main__":
+    main()
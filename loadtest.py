@@ -0,0 +1,578 @@
+"""Load test for the generation path in bot.py.
+
+Drives the bot's own interaction handlers (menu buttons, the prompt modal,
+delivery) against local stand-ins for Discord, the aivideoapi (Runway)
+endpoint, Supabase REST/Storage and Stripe, so we can see how the bot
+behaves at 50 or 500 concurrent generations without spending money:
+
+    python loadtest.py --users 50 --requests 200
+    GENERATION_CONCURRENCY=50 python loadtest.py --requests 500 --submit-error-rate 0.1
+
+Bot settings (GENERATION_CONCURRENCY, POLL_*, SUPABASE_WORKERS, ...) come
+from the environment as usual. The report covers throughput, p50/p99
+latency per flow, event-loop lag, calls caught blocking the loop (see
+LoopMonitor in bot.py) and memory; --json prints it as JSON so
+runs can be compared.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import discord
+from aiohttp import web
+
+# --- Mock servers ---
+# One aiohttp app on 127.0.0.1 plays Runway, Supabase and Stripe. It runs in
+# its own thread and event loop so its work doesn't show up as bot loop lag.
+
+PRIMARY_KEYS = {
+    "user_credits": ["user_id"],
+    "generation_jobs": ["job_id", "user_id"],
+    "stripe_events": ["event_id"],
+}
+LEDGER_ONCE_REASONS = ["purchase", "refund"]  # unique (reason, reference) in schema.sql
+VIDEO_CHUNK_SIZE = 256 * 1024
+
+def as_text(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def compare(op, actual, expected):
+    """Evaluates one PostgREST filter (e.g. eq.5, in.(a,b), lt.2025-01-01) against a column value."""
+    if op == "in":
+        return as_text(actual) in [item.strip('"') for item in expected.strip("()").split(",")]
+    if op == "is":
+        return as_text(actual) == expected
+    if op in ["eq", "neq"]:
+        return (as_text(actual) == expected) == (op == "eq")
+    if actual is None:
+        return False
+    try:
+        actual, expected = float(actual), float(expected)
+    except (TypeError, ValueError):
+        actual = as_text(actual)
+    return {"gt": actual > expected, "gte": actual >= expected, "lt": actual < expected, "lte": actual <= expected}[op]
+
+class MockServers:
+    """Fake aivideoapi, Supabase (REST + Storage) and Stripe APIs."""
+
+    def __init__(self, options):
+        self.options = options
+        self.tables = defaultdict(list)
+        self.jobs = {}  # job_id -> (ready_at, fails)
+        self.requests = Counter()  # "runway POST 200" -> count
+        self.base_url = None
+        self.loop = None
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._serve, name="mock-servers", daemon=True).start()
+        self._ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/runway/generate/text", self.runway_generate)
+        app.router.add_get("/runway/jobs/{job_id}", self.runway_job)
+        app.router.add_get("/videos/{job_id}.mp4", self.video)
+        app.router.add_post("/rest/v1/rpc/{function}", self.supabase_rpc)
+        app.router.add_route("*", "/rest/v1/{table}", self.supabase_rest)
+        app.router.add_route("*", "/storage/v1/object/{path:.*}", self.storage_upload)
+        app.router.add_post("/v1/checkout/sessions", self.stripe_checkout)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def delay(self, seconds):
+        if seconds > 0:
+            await asyncio.sleep(seconds * random.uniform(0.5, 1.5))
+
+    def count(self, service, method, detail):
+        self.requests[f"{service} {method} {detail}"] += 1
+
+    # Runway (aivideoapi)
+    async def runway_generate(self, request):
+        await request.json()
+        await self.delay(self.options.submit_latency)
+        roll = random.random()
+        if roll < self.options.rate_limit_rate:
+            self.count("runway", "POST", 429)
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+        if roll < self.options.rate_limit_rate + self.options.submit_error_rate:
+            self.count("runway", "POST", 503)
+            return web.json_response({"error": "unavailable"}, status=503)
+
+        job_id = str(uuid.uuid4())
+        duration = self.options.job_duration * random.uniform(0.8, 1.2)
+        self.jobs[job_id] = (self.loop.time() + duration, random.random() < self.options.job_failure_rate)
+        self.count("runway", "POST", 200)
+        return web.json_response({"id": job_id})
+
+    async def runway_job(self, request):
+        await self.delay(self.options.poll_latency)
+        job = self.jobs.get(request.match_info["job_id"])
+        if job is None:
+            self.count("runway", "GET", 404)
+            return web.json_response({"error": "not found"}, status=404)
+        if random.random() < self.options.poll_error_rate:
+            self.count("runway", "GET", 503)
+            return web.json_response({"error": "unavailable"}, status=503)
+
+        self.count("runway", "GET", 200)
+        ready_at, fails = job
+        if self.loop.time() < ready_at:
+            return web.json_response({"status": "running"})
+        if fails:
+            return web.json_response({"status": "failed"})
+        video_url = f"{self.base_url}/videos/{request.match_info['job_id']}.mp4"
+        return web.json_response({"status": "succeeded", "output": {"video_url": video_url}})
+
+    async def video(self, request):
+        self.count("video", "GET", 200)
+        response = web.StreamResponse(headers={"Content-Type": "video/mp4"})
+        response.content_length = self.options.video_size
+        await response.prepare(request)
+        remaining = self.options.video_size
+        chunk = b"\0" * VIDEO_CHUNK_SIZE
+        while remaining > 0:
+            await response.write(chunk[:remaining])
+            remaining -= VIDEO_CHUNK_SIZE
+        await response.write_eof()
+        return response
+
+    # Supabase
+    async def supabase_rest(self, request):
+        await self.delay(self.options.db_latency)
+        table = self.tables[request.match_info["table"]]
+        query = request.query
+        filters = [(column, *value.split(".", 1)) for column, value in query.items()
+                   if column not in ["select", "order", "limit", "offset", "on_conflict", "columns"]]
+        matching = [row for row in table if all(compare(op, row.get(column), expected) for column, op, expected in filters)]
+        self.count("supabase", request.method, request.match_info["table"])
+
+        if request.method == "GET":
+            for order in reversed(query.get("order", "").split(",") if query.get("order") else []):
+                column, _, direction = order.partition(".")
+                matching.sort(key=lambda row: as_text(row.get(column)), reverse=direction.startswith("desc"))
+            offset = int(query.get("offset", 0))
+            matching = matching[offset:offset + int(query["limit"])] if "limit" in query else matching[offset:]
+            if query.get("select", "*") != "*":
+                columns = [column.strip() for column in query["select"].split(",")]
+                matching = [{column: row.get(column) for column in columns} for row in matching]
+            return web.json_response(matching)
+
+        if request.method == "PATCH":
+            update = await request.json()
+            for row in matching:
+                row.update(update)
+            return web.json_response(matching)
+
+        if request.method == "DELETE":
+            for row in matching:
+                table.remove(row)
+            return web.json_response(matching)
+
+        rows = await request.json()
+        rows = rows if isinstance(rows, list) else [rows]
+        prefer = request.headers.get("Prefer", "")
+        keys = query["on_conflict"].split(",") if "on_conflict" in query else PRIMARY_KEYS.get(request.match_info["table"])
+        inserted = []
+        for row in rows:
+            existing = keys and next((old for old in table if all(as_text(old.get(k)) == as_text(row.get(k)) for k in keys)), None)
+            if existing:
+                if "merge-duplicates" in prefer:
+                    existing.update(row)
+                    inserted.append(existing)
+                elif "ignore-duplicates" not in prefer:
+                    return web.json_response({"code": "23505", "message": "duplicate key value violates unique constraint"}, status=409)
+                continue
+            table.append(dict(row))
+            inserted.append(row)
+        return web.json_response(inserted, status=201)
+
+    async def supabase_rpc(self, request):
+        await self.delay(self.options.db_latency)
+        function = request.match_info["function"]
+        args = await request.json()
+        self.count("supabase", "RPC", function)
+        if function == "change_credits":
+            return web.json_response([self.change_credits(args["change_user"], args["change_delta"],
+                                                          args["change_reason"], args.get("change_reference"))])
+        if function == "grant_credits_bulk":
+            applied = {}
+            for grant in args["grants"]:
+                result = self.change_credits(grant["user_id"], grant["delta"], args["grant_reason"], grant.get("reference"))
+                if result["applied"]:
+                    applied[grant["user_id"]] = {"user_id": grant["user_id"], "credits": result["balance"]}
+            return web.json_response(list(applied.values()))
+        return web.json_response({"message": f"function {function} not found"}, status=404)
+
+    def change_credits(self, user_id, delta, reason, reference):
+        """change_credits from schema.sql, applied to the mock tables."""
+        account = next((row for row in self.tables["user_credits"] if as_text(row["user_id"]) == as_text(user_id)), None)
+        balance = account["credits"] if account else 0
+        ledger = self.tables["credit_transactions"]
+        repeated = reason in LEDGER_ONCE_REASONS and any(row["reason"] == reason and row["reference"] == reference for row in ledger)
+        if balance + delta < 0 or repeated:
+            return {"balance": balance, "applied": False}
+
+        if account is None:
+            account = {"user_id": user_id, "credits": 0}
+            self.tables["user_credits"].append(account)
+        account["credits"] += delta
+        ledger.append({"user_id": as_text(user_id), "delta": delta, "balance_after": account["credits"],
+                       "reason": reason, "reference": reference})
+        return {"balance": account["credits"], "applied": True}
+
+    async def storage_upload(self, request):
+        size = len(await request.read())
+        await self.delay(self.options.db_latency)
+        self.count("storage", request.method, 200)
+        return web.json_response({"Key": request.match_info["path"], "Id": str(uuid.uuid4()), "size": size})
+
+    # Stripe
+    async def stripe_checkout(self, request):
+        await request.post()
+        await self.delay(self.options.stripe_latency)
+        self.count("stripe", "POST", 200)
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        return web.json_response({
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+        })
+
+# --- Fake Discord ---
+# Just enough of discord.Interaction and discord.User for the bot's handlers.
+# Every API call waits --discord-latency, like a round trip to Discord would.
+
+FAILURE_PREFIXES = ("❌", "⚠️", "🚧", "🔁")  # any reply that ends a flow without a DM
+
+class FakeUser:
+    def __init__(self, user_id, latency):
+        self.id = user_id
+        self.name = f"loadtest-{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.latency = latency
+        self.outcome = asyncio.get_running_loop().create_future()
+
+    def finish(self, outcome):
+        if not self.outcome.done():
+            self.outcome.set_result((outcome, time.perf_counter()))
+
+    async def send(self, content=None, file=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        if file is not None:
+            file.close()
+        self.finish("delivered")
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.modal = None
+
+    def is_done(self):
+        return self.interaction.acked_at is not None
+
+    async def _respond(self, content=None):
+        if self.is_done():
+            raise discord.InteractionResponded(self.interaction)
+        await asyncio.sleep(self.interaction.user.latency)
+        self.interaction.acked_at = time.perf_counter()
+        self.interaction.record(content)
+
+    async def defer(self, **kwargs):
+        await self._respond()
+
+    async def send_message(self, content=None, **kwargs):
+        await self._respond(content)
+
+    async def edit_message(self, content=None, **kwargs):
+        await self._respond(content)
+
+    async def send_modal(self, modal):
+        self.modal = modal
+        await self._respond()
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.interaction.user.latency)
+        self.interaction.record(content)
+
+class FakeInteraction:
+    def __init__(self, user, custom_id, type=discord.InteractionType.component):
+        self.id = random.getrandbits(63)
+        self.type = type
+        self.user = user
+        self.data = {"custom_id": custom_id}
+        self.created_at = time.perf_counter()
+        self.acked_at = None
+        self.messages = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    def record(self, content):
+        self.messages.append(content)
+        if content and content.startswith(FAILURE_PREFIXES):
+            self.user.finish(content)
+
+    @property
+    def ack_seconds(self):
+        return None if self.acked_at is None else self.acked_at - self.created_at
+
+# --- Flows ---
+
+class Results:
+    def __init__(self):
+        self.ack = defaultdict(list)  # flow -> seconds until the interaction was acknowledged
+        self.latency = defaultdict(list)  # flow -> seconds until the flow finished
+        self.outcomes = defaultdict(Counter)  # flow -> outcome -> count
+
+    def add(self, flow, started, outcome, interactions):
+        self.latency[flow].append(time.perf_counter() - started)
+        self.ack[flow].extend(i.ack_seconds for i in interactions if i.ack_seconds is not None)
+        self.outcomes[flow][outcome] += 1
+
+async def generate_flow(kolde, options, results, user_id, prompt):
+    """Video by Text Prompt -> ratio button -> prompt modal -> DM with the video."""
+    user = FakeUser(user_id, options.discord_latency)
+    started = time.perf_counter()
+    click = FakeInteraction(user, "video_text")
+    ratio = FakeInteraction(user, "ratio_16_9_video_text")
+    interactions = [click, ratio]
+    submit_task = None
+    try:
+        await kolde.dispatch_component(click)
+        if not user.outcome.done():
+            await kolde.dispatch_component(ratio)
+            modal = ratio.response.modal
+            modal.prompt._refresh_state({"value": prompt})
+            submit = FakeInteraction(user, modal.custom_id, discord.InteractionType.modal_submit)
+            interactions.append(submit)
+            submit_task = asyncio.create_task(modal.on_submit(submit))
+            await asyncio.wait([submit_task, user.outcome], timeout=options.timeout, return_when=asyncio.FIRST_EXCEPTION)
+            if submit_task.done() and submit_task.exception():
+                raise submit_task.exception()
+        outcome = user.outcome.result()[0] if user.outcome.done() else "timeout"
+    except Exception as e:
+        outcome = f"error: {type(e).__name__}"
+    finally:
+        if submit_task is not None and not submit_task.done():
+            submit_task.cancel()
+    results.add("generate", started, "delivered" if outcome == "delivered" else outcome.split(".")[0][:60], interactions)
+
+async def click_flow(kolde, options, results, user_id, custom_id):
+    """A single menu button; buy_credits also submits its modal to get a Stripe checkout link."""
+    user = FakeUser(user_id, options.discord_latency)
+    started = time.perf_counter()
+    click = FakeInteraction(user, custom_id)
+    interactions = [click]
+    try:
+        await kolde.dispatch_component(click)
+        if custom_id == "buy_credits":
+            modal = click.response.modal
+            modal.quantity._refresh_state({"value": "10"})
+            submit = FakeInteraction(user, modal.custom_id, discord.InteractionType.modal_submit)
+            interactions.append(submit)
+            await modal.on_submit(submit)
+        outcome = "failed" if user.outcome.done() else "ok"
+    except Exception as e:
+        outcome = f"error: {type(e).__name__}"
+    results.add(custom_id, started, outcome, interactions)
+
+# --- Sampling ---
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, not current, outside Linux
+
+async def sample(lag, memory, interval=0.05):
+    """Records how late each wakeup of the event loop is, plus RSS every ~0.5s."""
+    loop = asyncio.get_running_loop()
+    ticks = 0
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag.append(max(loop.time() - started - interval, 0))
+        ticks += 1
+        if ticks % 10 == 0:
+            memory.append(rss_bytes())
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+# --- Runner ---
+
+CLICK_FLOWS = ["check_credits", "history", "buy_credits", "get_access"]
+
+def configure_environment(options, mocks):
+    """Points bot.py at the mock servers. Must run before bot.py is imported."""
+    os.environ.update({
+        "DISCORD_TOKEN": "loadtest",
+        "RUNWAY_API_KEY": "loadtest",
+        "RUNWAY_API_BASE": mocks.base_url,
+        "SUPABASE_URL": mocks.base_url,
+        "SUPABASE_KEY": "loadtest.loadtest.loadtest",
+        "STRIPE_SECRET_KEY": "sk_test_loadtest",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if options.rehost:
+        os.environ.setdefault("VIDEO_BUCKET", "videos")
+
+async def run(options, mocks):
+    kolde = importlib.import_module("bot")
+    kolde.create_app()
+    kolde.stripe.api_base = mocks.base_url
+
+    user_ids = [10 ** 17 + i for i in range(options.users)]
+    for user_id in user_ids:
+        mocks.tables["user_credits"].append({"user_id": user_id, "credits": 10 ** 6})
+        kolde.access_index.grant(user_id)
+
+    kolde.loop_monitor.start()
+    await kolde.startup.run()  # the bot's own startup, minus the gateway and the menu
+
+    lag, memory = [], [rss_bytes()]
+    sampler = asyncio.create_task(sample(lag, memory))
+    results = Results()
+    distinct = options.distinct_prompts or options.requests
+    flows = [generate_flow(kolde, options, results, user_ids[i % options.users], f"load test prompt {i % distinct}")
+             for i in range(options.requests)]
+    flows += [click_flow(kolde, options, results, user_ids[i % options.users], CLICK_FLOWS[i % len(CLICK_FLOWS)])
+              for i in range(options.clicks)]
+    random.shuffle(flows)
+
+    async def arrive(index, flow):
+        if options.rate:
+            await asyncio.sleep(index / options.rate)
+        await flow
+
+    started = time.perf_counter()
+    await asyncio.gather(*(arrive(index, flow) for index, flow in enumerate(flows)))
+    elapsed = time.perf_counter() - started
+    memory.append(rss_bytes())
+
+    await kolde.delivery_pool.queue.join()  # let history writes for the last deliveries finish
+    sampler.cancel()
+    await kolde.loop_monitor.stop()
+    await kolde.job_poller.stop()
+    await kolde.delivery_pool.stop()
+    await kolde.fulfillment_worker.stop()
+    await kolde.close_http_session()
+    kolde.db_executor.shutdown(wait=False)
+    kolde.stripe_executor.shutdown(wait=False)
+
+    return {
+        "elapsed_seconds": elapsed,
+        "flows": {
+            flow: {
+                "count": len(latencies),
+                "outcomes": dict(results.outcomes[flow]),
+                "throughput_per_second": results.outcomes[flow].get("delivered" if flow == "generate" else "ok", 0) / elapsed,
+                "latency_p50": percentile(latencies, 50),
+                "latency_p99": percentile(latencies, 99),
+                "ack_p50": percentile(results.ack[flow], 50),
+                "ack_p99": percentile(results.ack[flow], 99),
+            }
+            for flow, latencies in results.latency.items()
+        },
+        "event_loop_lag": {"p50": percentile(lag, 50), "p99": percentile(lag, 99), "max": max(lag, default=None)},
+        "blocking_calls": dict(kolde.loop_monitor.blocks),
+        "memory_rss_bytes": {"start": memory[0], "peak": max(memory), "end": memory[-1]},
+        "result_cache": {"hits": kolde.result_cache.hits, "coalesced": kolde.result_cache.coalesced},
+        "mock_requests": dict(sorted(mocks.requests.items())),
+    }
+
+def print_report(options, report):
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+    def s(seconds):
+        return "-" if seconds is None else f"{seconds:.2f}s"
+
+    print(f"\n{options.requests} generations + {options.clicks} menu clicks from {options.users} users in {report['elapsed_seconds']:.1f}s\n")
+    print(f"{'flow':<14} {'n':>5} {'per sec':>8} {'p50':>9} {'p99':>9} {'ack p50':>9} {'ack p99':>9}  outcomes")
+    for flow, stats in sorted(report["flows"].items()):
+        outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in stats["outcomes"].items())
+        print(f"{flow:<14} {stats['count']:>5} {stats['throughput_per_second']:>8.2f} {s(stats['latency_p50']):>9} "
+              f"{s(stats['latency_p99']):>9} {ms(stats['ack_p50']):>9} {ms(stats['ack_p99']):>9}  {outcomes}")
+
+    lag = report["event_loop_lag"]
+    memory = report["memory_rss_bytes"]
+    print(f"\nevent loop lag  p50 {ms(lag['p50'])}, p99 {ms(lag['p99'])}, max {ms(lag['max'])}")
+    print(f"memory (RSS)    start {memory['start'] / 2 ** 20:.0f}MB, peak {memory['peak'] / 2 ** 20:.0f}MB, end {memory['end'] / 2 ** 20:.0f}MB")
+    if report["blocking_calls"]:
+        print("blocking calls  " + ", ".join(f"{where}: {count}" for where, count in report["blocking_calls"].items()))
+    print(f"result cache    {report['result_cache']['hits']} hits, {report['result_cache']['coalesced']} coalesced")
+    print("mock requests   " + ", ".join(f"{name}: {count}" for name, count in report["mock_requests"].items()))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test bot.py against local mock servers.")
+    parser.add_argument("--users", type=int, default=50, help="distinct Discord users")
+    parser.add_argument("--requests", type=int, default=100, help="video generations to run")
+    parser.add_argument("--clicks", type=int, default=0, help="extra menu clicks (check credits, history, buy credits, get access)")
+    parser.add_argument("--rate", type=float, default=0, help="arrivals per second (0: everything at once)")
+    parser.add_argument("--distinct-prompts", type=int, default=0, help="number of distinct prompts (0: all distinct); lower it to exercise the result cache")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds before a generation counts as timed out")
+    parser.add_argument("--job-duration", type=float, default=5, help="seconds a fake Runway job takes")
+    parser.add_argument("--submit-latency", type=float, default=0.3, help="Runway submit latency in seconds")
+    parser.add_argument("--poll-latency", type=float, default=0.1, help="Runway status check latency in seconds")
+    parser.add_argument("--submit-error-rate", type=float, default=0, help="share of submits answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of submits answered with 429")
+    parser.add_argument("--poll-error-rate", type=float, default=0, help="share of status checks answered with 503")
+    parser.add_argument("--job-failure-rate", type=float, default=0, help="share of jobs that end as failed")
+    parser.add_argument("--video-size", type=int, default=2 * 1024 * 1024, help="bytes per fake video")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Supabase request latency in seconds")
+    parser.add_argument("--stripe-latency", type=float, default=0.2, help="Stripe request latency in seconds")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Discord API round trip in seconds")
+    parser.add_argument("--no-rehost", dest="rehost", action="store_false", help="skip the Supabase Storage upload")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    mocks = MockServers(options)
+    mocks.start()
+    configure_environment(options, mocks)
+    try:
+        report = asyncio.run(run(options, mocks))
+    finally:
+        mocks.stop()
+
+    if options.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(options, report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+-- Supabase tables used by bot.py and webhook.py.
+-- user_credits and video_history predate this file; run the rest in the
+-- Supabase SQL editor (every statement is safe to re-run).
+
+-- Keyset pagination for the history view: WHERE user_id = ? AND generated_at < ? ORDER BY generated_at DESC
+create index if not exists video_history_user_generated_idx
+    on video_history (user_id, generated_at desc);
+
+-- One row per (provider job, user): identical requests can share a job.
+-- Paid requests start as status 'queued' under their request ID and are
+-- re-keyed to the provider job ID once they have one.
+create table if not exists generation_jobs (
+    job_id text not null,
+    user_id text not null,
+    prompt text,
+    aspect_ratio text,
+    image_url text,
+    credits integer not null default 0,
+    status text not null,
+    video_url text,
+    created_at timestamp not null,
+    updated_at timestamp not null,
+    primary key (job_id, user_id)
+);
+create index if not exists generation_jobs_status_idx on generation_jobs (status);
+
+create table if not exists credit_transactions (
+    id bigint generated always as identity primary key,
+    user_id text not null,
+    delta integer not null,
+    balance_after integer not null,
+    reason text not null,
+    reference text,
+    created_at timestamp not null
+);
+create index if not exists credit_transactions_user_idx on credit_transactions (user_id, created_at desc);
+create index if not exists credit_transactions_reference_idx on credit_transactions (reference);
+-- A purchase (referenced by its Stripe event ID) or a refund is in the ledger
+-- at most once; change_credits and grant_credits_bulk skip it the second time
+create unique index if not exists credit_transactions_once_idx
+    on credit_transactions (reason, reference) where reason in ('purchase', 'refund');
+
+-- Last credit activity per user, for the sort and inactive filter in /list_credits.
+-- Existing rows are backfilled from the ledger; users with no ledger rows count as inactive since 1970.
+alter table user_credits add column if not exists updated_at timestamp;
+update user_credits c set updated_at = t.last_at
+    from (select user_id, max(created_at) as last_at from credit_transactions group by user_id) t
+    where c.updated_at is null and t.user_id = c.user_id::text;
+update user_credits set updated_at = '1970-01-01' where updated_at is null;
+create index if not exists user_credits_credits_idx on user_credits (credits, user_id);
+create index if not exists user_credits_updated_idx on user_credits (updated_at, user_id);
+
+create table if not exists stripe_events (
+    event_id text primary key,
+    type text not null,
+    payload jsonb not null,
+    status text not null default 'pending',
+    attempts integer not null default 0,
+    last_error text,
+    received_at timestamp not null,
+    processed_at timestamp
+);
+create index if not exists stripe_events_status_idx on stripe_events (status, received_at);
+
+-- Changes one balance and logs it in the ledger in the same transaction (used
+-- for every credit change except bulk grants). Returns the balance and whether
+-- the change was applied: it isn't if the balance would go below zero, or if
+-- it's a purchase or refund whose reference is already in the ledger.
+create or replace function change_credits(change_user user_credits.user_id%type, change_delta integer,
+                                          change_reason text, change_reference text default null)
+returns table (balance integer, applied boolean)
+language plpgsql
+as $$
+declare
+    entry_id bigint;
+    new_balance integer;
+begin
+    if change_delta < 0 then
+        update user_credits set credits = credits + change_delta, updated_at = now() at time zone 'utc'
+            where user_id = change_user and credits + change_delta >= 0
+            returning credits into new_balance;
+        if new_balance is null then
+            return query select coalesce(max(c.credits), 0), false from user_credits c where c.user_id = change_user;
+            return;
+        end if;
+        insert into credit_transactions (user_id, delta, balance_after, reason, reference, created_at)
+            values (change_user::text, change_delta, new_balance, change_reason, change_reference, now() at time zone 'utc');
+        return query select new_balance, true;
+        return;
+    end if;
+
+    -- The ledger row goes in first, so a repeated purchase or refund stops here
+    insert into credit_transactions (user_id, delta, balance_after, reason, reference, created_at)
+        values (change_user::text, change_delta, 0, change_reason, change_reference, now() at time zone 'utc')
+        on conflict (reason, reference) where reason in ('purchase', 'refund') do nothing
+        returning id into entry_id;
+    if entry_id is null then
+        return query select coalesce(max(c.credits), 0), false from user_credits c where c.user_id = change_user;
+        return;
+    end if;
+    insert into user_credits as c (user_id, credits, updated_at)
+        values (change_user, change_delta, now() at time zone 'utc')
+        on conflict (user_id) do update set credits = c.credits + excluded.credits, updated_at = excluded.updated_at
+        returning c.credits into new_balance;
+    update credit_transactions set balance_after = new_balance where id = entry_id;
+    return query select new_balance, true;
+end;
+$$;
+
+-- Adds credits to many users in one upsert and logs every grant in the
+-- ledger (used by /bulk_grant and /refund_failed). Balances are incremented
+-- in place, so it can't race with other credit changes. Purchases and
+-- refunds already in the ledger are skipped, like in change_credits.
+-- grants: [{"user_id": "...", "delta": 5, "reference": "..."}, ...] with delta > 0
+create or replace function grant_credits_bulk(grants jsonb, grant_reason text)
+returns setof user_credits
+language plpgsql
+as $$
+declare
+    entry_ids bigint[];
+begin
+    with logged as (
+        insert into credit_transactions (user_id, delta, balance_after, reason, reference, created_at)
+        select item->>'user_id', (item->>'delta')::integer, 0, grant_reason, item->>'reference', now() at time zone 'utc'
+        from jsonb_array_elements(grants) as item
+        on conflict (reason, reference) where reason in ('purchase', 'refund') do nothing
+        returning id
+    )
+    select array_agg(id) into entry_ids from logged;
+
+    return query
+    with applied as (
+        -- one row per user: an upsert can't touch the same row twice
+        insert into user_credits as c (user_id, credits, updated_at)
+        select (jsonb_populate_record(null::user_credits, jsonb_build_object('user_id', t.user_id))).user_id,
+               sum(t.delta), now() at time zone 'utc'
+        from credit_transactions t where t.id = any(entry_ids)
+        group by t.user_id
+        on conflict (user_id) do update set credits = c.credits + excluded.credits, updated_at = excluded.updated_at
+        returning c.*
+    ), balances as (
+        update credit_transactions t set balance_after = applied.credits
+        from applied where t.id = any(entry_ids) and t.user_id = applied.user_id::text
+    )
+    select * from applied;
+end;
+$$;
@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# Single-process mode: the bot serves /stripe-webhook itself on $PORT,
+# sharing its gateway connection, caches and Supabase client
+if [ "$SERVE_WEBHOOK" = "1" ]; then
+    exec python bot.py
+fi
+
 # Start the Discord bot in the background
 python bot.py &
 
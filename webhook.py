@@ -1,28 +1,52 @@
 from flask import Flask, request, jsonify
 import stripe
 import os
-import discord
-import asyncio
+import json
+from datetime import datetime
+from supabase import create_client
 
 app = Flask(__name__)
 
 # Load environment variables
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 stripe.api_key = STRIPE_SECRET_KEY
+supabase = None
 
-# Discord Bot Setup
-intents = discord.Intents.default()
-bot = discord.Client(intents=intents)
+def get_supabase():
+    global supabase
+    if supabase is None:
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase
 
-ACCESS_ROLE_ID = 1227708209356345454  # Replace with your Discord role ID
-GUILD_ID = 1227704136552939551  # Replace with your Discord server ID
+# Events the bot's fulfillment worker acts on; everything else is acknowledged and dropped
+FULFILLMENT_EVENTS = ["checkout.session.completed"]
 
-@bot.event
-async def on_ready():
-    print(f"✅ Bot is online as {bot.user}")
+def record_event(payload, sig_header, client=None):
+    """Verifies a Stripe webhook and stores it in stripe_events for the bot to fulfil.
+
+    Events are keyed by their Stripe event ID, so retries of an event that
+    is already stored are ignored. bot.py passes its own Supabase client
+    when it serves the webhook itself. Returns the event type.
+    """
+    event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+    if event["type"] not in FULFILLMENT_EVENTS:
+        return event["type"]
+
+    # Store the raw JSON object rather than the StripeObject so the row is plain jsonb
+    data = json.loads(payload)["data"]["object"]
+    (client or get_supabase()).table("stripe_events").upsert({
+        "event_id": event["id"],
+        "type": event["type"],
+        "payload": data,
+        "status": "pending",
+        "attempts": 0,
+        "received_at": datetime.utcnow().isoformat()
+    }, on_conflict="event_id", ignore_duplicates=True).execute()
+    return event["type"]
 
 @app.route('/stripe-webhook', methods=['POST'])
 def stripe_webhook():
@@ -30,29 +54,15 @@ def stripe_webhook():
     sig_header = request.headers.get('Stripe-Signature')
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
-    except stripe.error.SignatureVerificationError:
+        record_event(payload, sig_header)
+    except (ValueError, stripe.error.SignatureVerificationError):
         return "Webhook signature verification failed", 400
-
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_id = int(session['metadata']['user_id'])
-
-        asyncio.run_coroutine_threadsafe(grant_access(user_id), bot.loop)
+    except Exception as e:
+        # Not stored, so let Stripe retry the delivery
+        print(f"❌ Could not store Stripe event: {e}")
+        return "Could not store event", 500
 
     return jsonify(success=True)
 
-async def grant_access(user_id):
-    """Grants the Discord role to the user after payment."""
-    guild = bot.get_guild(GUILD_ID)
-    if guild:
-        member = guild.get_member(user_id)
-        if member:
-            role = guild.get_role(ACCESS_ROLE_ID)
-            if role:
-                await member.add_roles(role)
-                print(f"✅ Granted access role to {member.name}")
-
 if __name__ == '__main__':
-    bot.loop.create_task(bot.start(DISCORD_TOKEN))  # Start Discord bot in async loop
     app.run(host="0.0.0.0", port=10000)  # Make sure it runs on Render